@@ -8,6 +8,7 @@ __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
 import os
+import operator
 import pandas as pd
 import numpy as np
 import six
@@ -16,15 +17,27 @@ from sklearn.metrics.pairwise import pairwise_distances
 from sklearn.manifold import MDS
 from sklearn.utils import check_random_state
 from scipy.spatial.distance import squareform
+from scipy.sparse import csr_matrix, issparse, triu, vstack as sparse_vstack
 from scipy.stats import ttest_1samp
 import seaborn as sns
 import matplotlib.pyplot as plt
 from nltools.stats import (correlation_permutation,
-                           one_sample_permutation,
                            two_sample_permutation,
                            summarize_bootstrap,
                            matrix_permutation,
-                           jackknife_permutation)
+                           jackknife_permutation,
+                           _covariance_stack,
+                           _roi_timeseries,
+                           _permute_blocks,
+                           _block_size,
+                           _permute_sign_edges,
+                           _sign_flip_t,
+                           _suprathreshold,
+                           _nbs_components,
+                           _fwe_pvalue,
+                           _design_basis,
+                           _design_t,
+                           _permute_design_edges)
 from nltools.stats import regress as regression
 from nltools.plotting import (plot_stacked_adjacency,
                               plot_silhouette)
@@ -41,6 +54,99 @@ nx = attempt_to_import('networkx', 'nx')
 MAX_INT = np.iinfo(np.int32).max
 
 
+def _n_nodes(n_edges, issymmetric):
+    ''' Number of nodes of a condensed matrix with n_edges entries.'''
+    if issymmetric:
+        return int(round((1 + np.sqrt(1 + 8 * n_edges)) / 2))
+    return int(round(np.sqrt(n_edges)))
+
+
+def _row_offsets(n_nodes):
+    ''' Condensed index of the first upper triangle entry of each row.'''
+    i = np.arange(n_nodes, dtype=np.int64)
+    return i * n_nodes - i * (i + 1) // 2
+
+
+def _condensed_edges(data, issymmetric):
+    ''' Node pairs and weights of the non-zero entries of a sparse condensed
+        (1 x edges) matrix.
+
+    Args:
+        data: (csr_matrix) single condensed matrix
+        issymmetric: (bool) whether data is an upper triangle
+
+    Returns:
+        n_nodes: (int) number of nodes
+        source: (np.array) row node of each edge
+        target: (np.array) column node of each edge
+        weight: (np.array) value of each edge
+
+    '''
+    data = data.tocoo()
+    n_nodes = _n_nodes(data.shape[1], issymmetric)
+    index = data.col.astype(np.int64)
+    if issymmetric:
+        offsets = _row_offsets(n_nodes)
+        source = np.searchsorted(offsets, index, side='right') - 1
+        target = index - offsets[source] + source + 1
+    else:
+        source, target = np.divmod(index, n_nodes)
+    return n_nodes, source, target, data.data
+
+
+def _condensed_to_square(data, issymmetric):
+    ''' Convert a sparse condensed (1 x edges) matrix to a sparse square
+        matrix.'''
+    n_nodes, source, target, weight = _condensed_edges(data, issymmetric)
+    if issymmetric:
+        source, target = (np.concatenate([source, target]),
+                          np.concatenate([target, source]))
+        weight = np.concatenate([weight, weight])
+    return csr_matrix((weight, (source, target)), shape=(n_nodes, n_nodes))
+
+
+def _square_to_condensed(data, issymmetric):
+    ''' Convert a sparse square matrix to a sparse condensed (1 x edges)
+        matrix.'''
+    n_nodes = data.shape[0]
+    if issymmetric:
+        data = triu(data, k=1, format='coo')
+        index = (_row_offsets(n_nodes)[data.row] + data.col - data.row - 1)
+        n_edges = n_nodes * (n_nodes - 1) // 2
+    else:
+        data = data.tocoo()
+        index = data.row.astype(np.int64) * n_nodes + data.col
+        n_edges = n_nodes * n_nodes
+    return csr_matrix((data.data, (np.zeros(len(index), dtype=int), index)),
+                      shape=(1, n_edges))
+
+
+def _edge_nodes(n_nodes, issymmetric):
+    ''' Node pairs of each entry of a condensed matrix.'''
+    if issymmetric:
+        return np.triu_indices(n_nodes, k=1)
+    return np.divmod(np.arange(n_nodes * n_nodes), n_nodes)
+
+
+def _percentile(data, q):
+    ''' Percentile over all entries of dense or sparse data, counting the
+        implicit zeros of sparse data without densifying it.'''
+    if not issparse(data):
+        return np.percentile(data, q)
+    values = np.sort(data.data)
+    if not len(values):
+        return 0.
+    n_zeros = np.prod(data.shape) - len(values)
+    n_negative = np.searchsorted(values, 0)
+    rank = q / 100 * (np.prod(data.shape) - 1)
+    bounds = np.array([np.floor(rank), np.ceil(rank)], dtype=np.int64)
+    bound_values = np.where(bounds < n_negative,
+                            values[np.minimum(bounds, len(values) - 1)], 0.)
+    upper = bounds >= n_negative + n_zeros
+    bound_values[upper] = values[bounds[upper] - n_zeros]
+    return bound_values[0] + (rank - bounds[0]) * (bound_values[1] - bound_values[0])
+
+
 class Adjacency(object):
 
     '''
@@ -54,12 +160,14 @@ class Adjacency(object):
                     ['distance','similarity','directed','distance_flat',
                     'similarity_flat','directed_flat']
         Y: Pandas DataFrame of training labels
+        sparse: (bool) store the condensed matrices as a scipy.sparse csr
+                matrix; always True if data is a scipy.sparse matrix
         **kwargs: Additional keyword arguments
 
     '''
 
     def __init__(self, data=None, Y=None, matrix_type=None, labels=None,
-                 **kwargs):
+                 sparse=False, **kwargs):
         if matrix_type is not None:
             if matrix_type.lower() not in ['distance', 'similarity', 'directed',
                                            'distance_flat', 'similarity_flat',
@@ -73,6 +181,8 @@ class Adjacency(object):
             self.matrix_type = 'empty'
             self.is_single_matrix = np.nan
             self.issymmetric = np.nan
+        elif issparse(data):
+            self.data, self.issymmetric, self.matrix_type, self.is_single_matrix = self._import_sparse_data(data, matrix_type=matrix_type)
         elif isinstance(data, list):
             if isinstance(data[0], Adjacency):
                 tmp = concatenate(data)
@@ -100,6 +210,9 @@ class Adjacency(object):
         else:
             self.data, self.issymmetric, self.matrix_type, self.is_single_matrix = self._import_single_data(data, matrix_type=matrix_type)
 
+        if sparse and not self.isempty() and not issparse(self.data):
+            self.data = csr_matrix(np.atleast_2d(self.data))
+
         if Y is not None:
             if isinstance(Y, six.string_types):
                 if os.path.isfile(Y):
@@ -137,6 +250,108 @@ class Adjacency(object):
         else:
             self.labels = None
 
+    @classmethod
+    def from_stack(cls, data, matrix_type=None, validate=True):
+        ''' Create an Adjacency instance from a stack of square matrices.
+            Symmetry is checked with a single comparison over the whole
+            stack and the upper triangles are extracted with one gather,
+            instead of importing each matrix separately.
+
+        Args:
+            data: (np.array, list) 3D matrices by nodes by nodes array or
+                  list of square matrices of the same shape
+            matrix_type: (str) 'distance', 'similarity' or 'directed'; if
+                         None, inferred from the symmetry and diagonals of
+                         the matrices
+            validate: (bool) check that distance and similarity matrices
+                      are symmetric; set to False to skip the check for
+                      trusted input
+
+        Returns:
+            out: (Adjacency) Adjacency instance with one matrix per item
+
+        '''
+        data = np.asarray(data)
+        if data.ndim != 3 or data.shape[1] != data.shape[2]:
+            raise ValueError('Data must be a stack of square matrices.')
+        n_nodes = data.shape[1]
+
+        if matrix_type is None:
+            if np.array_equal(data, data.transpose(0, 2, 1)):
+                diag = np.trace(data, axis1=1, axis2=2)
+                if np.all(diag == 0):
+                    matrix_type = 'distance'
+                elif np.all(diag == n_nodes):
+                    matrix_type = 'similarity'
+                else:
+                    raise ValueError('Not all matrices are of the same matrix '
+                                     'type.')
+            else:
+                matrix_type = 'directed'
+        else:
+            matrix_type = matrix_type.lower()
+            if matrix_type not in ['distance', 'similarity', 'directed']:
+                raise ValueError("matrix_type must be [None, 'distance', "
+                                 "'similarity', 'directed']")
+            if (validate and matrix_type != 'directed' and
+                    not np.array_equal(data, data.transpose(0, 2, 1))):
+                raise ValueError('%s matrices must be symmetric.' % matrix_type)
+
+        out = cls()
+        if matrix_type == 'directed':
+            out.data = data.reshape(len(data), -1).copy()
+        else:
+            out.data = data[(slice(None),) + np.triu_indices(n_nodes, k=1)]
+        out.matrix_type = matrix_type
+        out.issymmetric = matrix_type != 'directed'
+        out.is_single_matrix = False
+        return out
+
+    @classmethod
+    def from_timeseries(cls, data, mask=None, estimator='empirical',
+                        kind='correlation'):
+        ''' Estimate functional connectivity matrices from time series,
+            for many subjects at once. Covariances are shrunk and converted
+            to (partial) correlations with batched linear algebra and the
+            upper triangles are stored directly.
+
+        Args:
+            data: (list, np.array) list of samples by ROIs arrays or
+                  DataFrames (one per subject), a 3D subjects by samples by
+                  ROIs array, or a list of Brain_Data instances with mask
+            mask: (nifti, Brain_Data) atlas with a different integer for
+                  each ROI, used to extract the mean ROI time series of
+                  each Brain_Data once
+            estimator: (str) covariance estimator; 'empirical',
+                       'ledoit_wolf' or 'oas'
+            kind: (str) 'correlation' or 'partial_correlation'
+
+        Returns:
+            out: (Adjacency) one similarity matrix per subject
+
+        '''
+        if kind not in ['correlation', 'partial_correlation']:
+            raise ValueError("kind must be 'correlation' or "
+                             "'partial_correlation'")
+        if mask is not None:
+            data = _roi_timeseries(data, mask)
+        elif isinstance(data, np.ndarray) and data.ndim != 3:
+            raise ValueError('Array data must be 3D (subjects x samples x '
+                             'ROIs).')
+        data = [np.asarray(x, dtype=float) for x in data]
+        if len(set(x.shape[1] for x in data)) > 1:
+            raise ValueError('All subjects must have the same number of ROIs.')
+
+        cov, _ = _covariance_stack(data, estimator=estimator)
+        sign = 1
+        if kind == 'partial_correlation':
+            # Partial correlations are the negated, normalized precision
+            cov, sign = np.linalg.inv(cov), -1
+        scale = 1 / np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        i, j = np.triu_indices(cov.shape[1], k=1)
+        return cls(sign * cov[:, i, j] * scale[:, i] * scale[:, j],
+                   matrix_type='similarity_flat')
+
     def __repr__(self):
         return ("%s.%s(shape=%s, square_shape=%s, Y=%s, is_symmetric=%s,"
                 "matrix_type=%s)") % (
@@ -150,7 +365,10 @@ class Adjacency(object):
 
     def __getitem__(self, index):
         new = self.copy()
-        if isinstance(index, int):
+        if self.issparse():
+            new.data = self.data[index]
+            new.is_single_matrix = isinstance(index, int)
+        elif isinstance(index, int):
             new.data = np.array(self.data[index, :]).flatten()
             new.is_single_matrix = True
         else:
@@ -170,36 +388,35 @@ class Adjacency(object):
             yield self[x]
 
     def __add__(self, y):
-        new = deepcopy(self)
-        if isinstance(y, (int, float)):
-            new.data = new.data + y
-        if isinstance(y, Adjacency):
-            if self.shape() != y.shape():
-                raise ValueError('Both Adjacency() instances need to be the '
-                                 'same shape.')
-            new.data = new.data + y.data
-        return new
+        return self._arithmetic(y, operator.add)
 
     def __sub__(self, y):
-        new = deepcopy(self)
-        if isinstance(y, (int, float)):
-            new.data = new.data - y
-        if isinstance(y, Adjacency):
-            if self.shape() != y.shape():
-                raise ValueError('Both Adjacency() instances need to be the '
-                                 'same shape.')
-            new.data = new.data - y.data
-        return new
+        return self._arithmetic(y, operator.sub)
 
     def __mul__(self, y):
+        return self._arithmetic(y, operator.mul)
+
+    def _arithmetic(self, y, op):
+        ''' Helper function for elementwise arithmetic. Sparse data stays
+            sparse unless the result would no longer be sparse.'''
+
         new = deepcopy(self)
         if isinstance(y, (int, float)):
-            new.data = new.data * y
+            if new.issparse() and op is not operator.mul and y != 0:
+                new = new.to_dense()
+            new.data = op(new.data, y)
         if isinstance(y, Adjacency):
             if self.shape() != y.shape():
                 raise ValueError('Both Adjacency() instances need to be the '
                                  'same shape.')
-            new.data = np.multiply(new.data, y.data)
+            if new.issparse() and y.issparse():
+                if op is operator.mul:
+                    new.data = new.data.multiply(y.data).tocsr()
+                else:
+                    new.data = op(new.data, y.data)
+            else:
+                new = new.to_dense()
+                new.data = op(new.data, y.to_dense().data)
         return new
 
     def _import_single_data(self, data, matrix_type=None):
@@ -292,12 +509,78 @@ class Adjacency(object):
 
         return (data, issymmetric, matrix_type, is_single_matrix)
 
+    def _import_sparse_data(self, data, matrix_type=None):
+        ''' Helper function to import a scipy.sparse square matrix or a
+            sparse stack of condensed matrices (with a '_flat' matrix_type).'''
+
+        data = csr_matrix(data)
+        if matrix_type is not None and matrix_type.lower().endswith('_flat'):
+            matrix_type = matrix_type.lower()[:-len('_flat')]
+            return (data, matrix_type != 'directed', matrix_type,
+                    data.shape[0] == 1)
+
+        if data.shape[0] != data.shape[1]:
+            raise ValueError('Data matrix must be square')
+        if matrix_type is None:
+            issymmetric = (data != data.T).nnz == 0
+            if issymmetric:
+                diag = data.diagonal().sum()
+                if diag == 0:
+                    matrix_type = 'distance'
+                elif diag == data.shape[0]:
+                    matrix_type = 'similarity'
+                else:
+                    raise ValueError('Could not determine matrix_type of '
+                                     'symmetric matrix; please specify it.')
+            else:
+                matrix_type = 'directed'
+        else:
+            matrix_type = matrix_type.lower()
+            issymmetric = matrix_type != 'directed'
+        return (_square_to_condensed(data, issymmetric), issymmetric,
+                matrix_type, True)
+
     def isempty(self):
         '''Check if Adjacency object is empty'''
         return bool(self.matrix_type == 'empty')
 
-    def squareform(self):
-        '''Convert adjacency back to squareform'''
+    def issparse(self):
+        '''Check if Adjacency data is stored as a scipy.sparse matrix'''
+        return issparse(self.data)
+
+    def to_sparse(self):
+        ''' Create a copy of Adjacency object with data stored as a
+            scipy.sparse csr matrix.'''
+        out = self.copy()
+        if not self.issparse():
+            out.data = csr_matrix(np.atleast_2d(self.data))
+        return out
+
+    def to_dense(self):
+        ''' Create a copy of Adjacency object with data stored as a numpy
+            array.'''
+        out = self.copy()
+        if self.issparse():
+            out.data = self.data.toarray()
+            if self.is_single_matrix:
+                out.data = out.data.ravel()
+        return out
+
+    def squareform(self, sparse=False):
+        '''Convert adjacency back to squareform.
+
+        Args:
+            sparse: (bool) return scipy.sparse csr matrices instead of numpy
+                    arrays; default False
+
+        '''
+        if sparse or self.issparse():
+            data = self.data if self.issparse() else csr_matrix(np.atleast_2d(self.data))
+            out = [_condensed_to_square(data[i], self.issymmetric)
+                   for i in range(data.shape[0])]
+            if not sparse:
+                out = [x.toarray() for x in out]
+            return out[0] if self.is_single_matrix else out
         if self.issymmetric:
             if self.is_single_matrix:
                 return squareform(self.data)
@@ -314,6 +597,9 @@ class Adjacency(object):
     def plot(self, limit=3, *args, **kwargs):
         ''' Create Heatmap of Adjacency Matrix'''
 
+        if self.issparse():
+            return self.to_dense().plot(limit, *args, **kwargs)
+
         if self.is_single_matrix:
             f, a = plt.subplots(nrows=1, figsize=(7, 5))
             if self.labels is None:
@@ -352,6 +638,15 @@ class Adjacency(object):
 
         '''
 
+        if self.issparse():
+            if self.is_single_matrix:
+                return self.data.mean()
+            if axis == 0:
+                return Adjacency(data=csr_matrix(self.data.mean(axis=0)),
+                                 matrix_type=self.matrix_type + '_flat')
+            elif axis == 1:
+                return np.asarray(self.data.mean(axis=1)).ravel()
+
         if self.is_single_matrix:
             return np.mean(self.data)
         else:
@@ -374,6 +669,9 @@ class Adjacency(object):
 
         '''
 
+        if self.issparse():
+            return self.to_dense().std(axis=axis)
+
         if self.is_single_matrix:
             return np.std(self.data)
         else:
@@ -385,6 +683,8 @@ class Adjacency(object):
 
     def shape(self):
         ''' Calculate shape of data. '''
+        if self.issparse() and self.is_single_matrix:
+            return (self.data.shape[1],)
         return self.data.shape
 
     def square_shape(self):
@@ -423,7 +723,11 @@ class Adjacency(object):
                 raise ValueError('Data is not the same shape as Adjacency '
                                  'instance.')
 
-            out.data = np.vstack([self.data, data.data])
+            if self.issparse() or data.issparse():
+                out.data = sparse_vstack([self.to_sparse().data,
+                                          data.to_sparse().data], format='csr')
+            else:
+                out.data = np.vstack([self.data, data.data])
             out.is_single_matrix = False
             if out.Y.size:
                 out.Y = self.Y.append(data.Y)
@@ -431,7 +735,8 @@ class Adjacency(object):
         return out
 
     def write(self, file_name, method='long'):
-        ''' Write out Adjacency object to csv file.
+        ''' Write out Adjacency object to csv file. Sparse data is written
+            in the same dense layout.
 
             Args:
                 file_name (str):  name of file name to write
@@ -440,6 +745,8 @@ class Adjacency(object):
         '''
         if method not in ['long', 'square']:
             raise ValueError('Make sure method is ["long","square"].')
+        if self.issparse():
+            return self.to_dense().write(file_name, method=method)
         if self.is_single_matrix:
             if method == 'long':
                 pd.DataFrame(self.data).to_csv(file_name, index=None)
@@ -456,17 +763,23 @@ class Adjacency(object):
     def similarity(self, data, plot=False, perm_type='2d', n_permute=5000,
                    metric='spearman', **kwargs):
         ''' Calculate similarity between two Adjacency matrices.
-        Default is to use spearman correlation and permutation test.
+        Default is to use spearman correlation and permutation test. For
+        multiple matrices, data is ranked once and the same permutations
+        are shared by all matrices (except for 'jackknife').
         Args:
             data: Adjacency data, or 1-d array same size as self.data
             perm_type: (str) '1d','2d', 'jackknife', or None
             metric: (str) 'spearman','pearson','kendall'
+        Returns:
+            stats: (dict) permutation results ['correlation','p'] for a
+                   single matrix, or a pd.DataFrame with one row per matrix
+                   for multiple matrices
         '''
-        data1 = self.copy()
+        data1 = self.to_dense()
         if not isinstance(data, Adjacency):
-            data2 = Adjacency(data)
+            data2 = Adjacency(data).to_dense()
         else:
-            data2 = data.copy()
+            data2 = data.to_dense()
 
         if perm_type is None:
             n_permute = 0
@@ -507,12 +820,25 @@ class Adjacency(object):
                 _, a = plt.subplots(len(self))
                 for i in a:
                     plot_stacked_adjacency(self, data, ax=i)
-            return [similarity_func(_convert_data_similarity(x,
-                                                             perm_type=perm_type),
-                                    _convert_data_similarity(data2,
-                                                             perm_type=perm_type),
-                                    metric=metric, n_permute=n_permute,
-                                    **kwargs) for x in self]
+            if perm_type == 'jackknife':
+                stats = [similarity_func(_convert_data_similarity(x,
+                                                                  perm_type=perm_type),
+                                         _convert_data_similarity(data2,
+                                                                  perm_type=perm_type),
+                                         metric=metric, n_permute=n_permute,
+                                         **kwargs) for x in data1]
+                stats = {'correlation': [x['correlation'] for x in stats],
+                         'p': [x['p'] for x in stats]}
+            else:
+                stats = similarity_func([_convert_data_similarity(x,
+                                                                  perm_type=perm_type)
+                                         for x in data1],
+                                        _convert_data_similarity(data2,
+                                                                 perm_type=perm_type),
+                                        metric=metric, n_permute=n_permute,
+                                        **kwargs)
+            return pd.DataFrame({'correlation': stats['correlation'],
+                                 'p': stats['p']})
 
     def distance(self, method='correlation', **kwargs):
         ''' Calculate distance between images within an Adjacency() instance.
@@ -525,10 +851,11 @@ class Adjacency(object):
             dist: (Adjacency) Outputs a 2D distance matrix.
 
         '''
-        return Adjacency(pairwise_distances(self.data, metric=method, **kwargs),
+        return Adjacency(pairwise_distances(self.to_dense().data, metric=method,
+                                            **kwargs),
                          matrix_type='distance')
 
-    def threshold(self, upper=None, lower=None, binarize=False):
+    def threshold(self, upper=None, lower=None, binarize=False, sparse=False):
         '''Threshold Adjacency instance. Provide upper and lower values or
            percentages to perform two-sided thresholding. Binarize will return
            a mask image respecting thresholds if provided, otherwise respecting
@@ -544,6 +871,8 @@ class Adjacency(object):
             binarize (bool): return binarized image respecting thresholds if
                     provided, otherwise binarize on every non-zero value;
                     default False
+            sparse (bool): store the result as a scipy.sparse matrix;
+                    sparse data always stays sparse; default False
 
         Returns:
             Adjacency: thresholded Adjacency instance
@@ -553,27 +882,43 @@ class Adjacency(object):
         b = self.copy()
         if isinstance(upper, six.string_types):
             if upper[-1] == '%':
-                upper = np.percentile(b.data, float(upper[:-1]))
+                upper = _percentile(b.data, float(upper[:-1]))
         if isinstance(lower, six.string_types):
             if lower[-1] == '%':
-                lower = np.percentile(b.data, float(lower[:-1]))
+                lower = _percentile(b.data, float(lower[:-1]))
 
+        # Zeros are unaffected by thresholding, so only the stored values of
+        # sparse data need to be updated
+        values = b.data.data if b.issparse() else b.data
         if upper and lower:
-            b.data[(b.data < upper) & (b.data > lower)] = 0
+            values[(values < upper) & (values > lower)] = 0
         elif upper and not lower:
-            b.data[b.data < upper] = 0
+            values[values < upper] = 0
         elif lower and not upper:
-            b.data[b.data > lower] = 0
+            values[values > lower] = 0
         if binarize:
-            b.data[b.data != 0] = 1
+            values[values != 0] = 1
+
+        if b.issparse():
+            b.data.eliminate_zeros()
+        elif sparse:
+            b.data = csr_matrix(np.atleast_2d(b.data))
         return b
 
     def to_graph(self):
         ''' Convert Adjacency into networkx graph.  only works on
-            single_matrix for now.'''
+            single_matrix for now. Sparse data is added as an edge list
+            without creating the square matrix.'''
 
         if self.is_single_matrix:
-            if self.matrix_type == 'directed':
+            if self.issparse():
+                G = nx.DiGraph() if self.matrix_type == 'directed' else nx.Graph()
+                n_nodes, source, target, weight = _condensed_edges(
+                    self.data, self.issymmetric)
+                G.add_nodes_from(range(n_nodes))
+                G.add_weighted_edges_from(zip(source.tolist(), target.tolist(),
+                                              weight.tolist()))
+            elif self.matrix_type == 'directed':
                 G = nx.DiGraph(self.squareform())
             else:
                 G = nx.Graph(self.squareform())
@@ -585,35 +930,130 @@ class Adjacency(object):
             raise NotImplementedError('This function currently only works on '
                                       'single matrices.')
 
-    def ttest(self, permutation=False, **kwargs):
-        ''' Calculate ttest across samples.
+    def ttest(self, permutation=False, n_permute=5000, tail=2, fwe=False,
+              nbs_threshold=None, n_jobs=-1, random_state=None):
+        ''' Calculate ttest across samples. Permutation tests flip the signs
+            of each sample's matrix, with all edges tested on the same sign
+            flips as one matrix product computed in blocks.
 
         Args:
-            permutation: (bool) Run ttest as permutation. Note this can be very slow.
+            permutation: (bool) Run ttest as permutation.
+            n_permute: (int) number of permutations
+            tail: (int) either 1 for one-tail or 2 for two-tailed test
+            fwe: (bool) also return edge p-values corrected with the
+                 maximum t statistic across edges; requires permutation
+            nbs_threshold: (float) primary t threshold for network based
+                           statistic inference on connected suprathreshold
+                           edges; requires permutation
+            n_jobs: (int) The number of CPUs to use to do the computation.
+                    -1 means all CPUs.
+            random_state: random_state instance for permutation
 
         Returns:
             out: (dict) contains Adjacency instances of t values (or mean if
-                 running permutation) and Adjacency instance of p values.
+                 running permutation) and Adjacency instance of p values,
+                 with 'p_fwe' if fwe and 'nbs' if nbs_threshold. 'nbs' is a
+                 dict with the Adjacency of 'components' (edges labeled
+                 from 1 by decreasing size), and the 'size' (edges) and
+                 corrected 'p' of each component.
 
         '''
         if self.is_single_matrix:
             raise ValueError('t-test cannot be run on single matrices.')
+        if (fwe or nbs_threshold is not None) and not permutation:
+            raise ValueError('fwe and nbs_threshold require permutation.')
 
         if permutation:
-            t = []
-            p = []
-            for i in range(self.data.shape[1]):
-                stats = one_sample_permutation(self.data[:, i], **kwargs)
-                t.append(stats['mean'])
-                p.append(stats['p'])
-            t = Adjacency(np.array(t))
-            p = Adjacency(np.array(p))
+            data = np.asarray(self.to_dense().data, dtype=float)
+            n_nodes = self.square_shape()[0]
+            source, target = _edge_nodes(n_nodes, self.issymmetric)
+            mean = data.mean(axis=0)
+            counts, max_t, min_t, max_size = _permute_blocks(
+                _permute_sign_edges, n_permute,
+                _block_size(sum(data.shape)), n_jobs=n_jobs,
+                random_state=random_state, data=data, stat=mean, tail=tail,
+                fwe=fwe, nbs_threshold=nbs_threshold, source=source, target=target,
+                n_nodes=n_nodes)
+            t = self.mean().copy()
+            p = deepcopy(t)
+            t.data, p.data = mean, counts.sum(axis=0) / n_permute
+            out = {'t': t, 'p': p}
+
+            stat = _sign_flip_t(mean, (data ** 2).sum(axis=0), len(data))
+            if fwe:
+                out['p_fwe'] = deepcopy(t)
+                out['p_fwe'].data = _fwe_pvalue(stat, max_t, min_t, tail)
+            if nbs_threshold is not None:
+                labels, size, p_nbs = _nbs_components(
+                    _suprathreshold(stat, nbs_threshold, tail), max_size,
+                    source, target, n_nodes)
+                components = deepcopy(t)
+                components.data = labels
+                out['nbs'] = {'components': components, 'size': size,
+                              'p': p_nbs}
         else:
             t = self.mean().copy()
             p = deepcopy(t)
-            t.data, p.data = ttest_1samp(self.data, 0, 0)
+            t.data, p.data = ttest_1samp(self.to_dense().data, 0, 0)
+            out = {'t': t, 'p': p}
+
+        return out
+
+    def nbs(self, design, threshold, n_permute=5000, contrast=None, tail=2,
+            n_jobs=-1, random_state=None):
+        ''' Network based statistic for a contrast of a general linear model
+            fit to every edge, e.g., a group comparison. Edges whose t
+            statistic exceeds threshold are grouped into connected
+            components, which are tested against the largest component of
+            each permutation of the rows of the design. The t maps of each
+            block of permutations are computed as one matrix product.
+
+        Args:
+            design: (Design_Matrix, pd.DataFrame, np.array) matrices by
+                    regressors design matrix; include an intercept
+            threshold: (float) primary t threshold
+            n_permute: (int) number of permutations
+            contrast: (list, np.array) weight of each regressor; tests the
+                      last regressor by default
+            tail: (int) either 1 for one-tail or 2 for two-tailed test
+            n_jobs: (int) The number of CPUs to use to do the computation.
+                    -1 means all CPUs.
+            random_state: random_state instance for permutation
+
+        Returns:
+            out: (dict) Adjacency instances of the contrast 't' values and
+                 of the 'components' (edges labeled from 1 by decreasing
+                 size), and the 'size' (edges) and family-wise error
+                 corrected 'p' of each component.
 
-        return {'t': t, 'p': p}
+        '''
+        if self.is_single_matrix:
+            raise ValueError('nbs cannot be run on single matrices.')
+        if len(design) != len(self):
+            raise ValueError('Design matrix must have same number of '
+                             'observations as Adjacency')
+
+        data = np.asarray(self.to_dense().data, dtype=float)
+        n_nodes = self.square_shape()[0]
+        source, target = _edge_nodes(n_nodes, self.issymmetric)
+        basis, weights = _design_basis(design, contrast=contrast)
+        sumsq = np.square(data).sum(axis=0)
+        stat = _design_t(np.dot(basis.T, data), weights, sumsq,
+                         len(data) - basis.shape[1])
+        max_size = _permute_blocks(
+            _permute_design_edges, n_permute,
+            _block_size(basis.shape[1] * sum(data.shape)), n_jobs=n_jobs,
+            random_state=random_state, data=data, sumsq=sumsq, basis=basis,
+            weights=weights, nbs_threshold=threshold, tail=tail,
+            source=source, target=target, n_nodes=n_nodes)
+        labels, size, p = _nbs_components(
+            _suprathreshold(stat, threshold, tail), max_size, source, target,
+            n_nodes)
+
+        t = self.mean().copy()
+        components = deepcopy(t)
+        t.data, components.data = stat, labels
+        return {'t': t, 'components': components, 'size': size, 'p': p}
 
     def plot_label_distance(self, labels=None, ax=None):
         ''' Create a violin plot indicating within and between label distance
@@ -738,8 +1178,9 @@ class Adjacency(object):
 
         random_state = check_random_state(random_state)
         seeds = random_state.randint(MAX_INT, size=n_samples)
+        data = self.to_dense()
         bootstrapped = Parallel(n_jobs=n_jobs)(
-                        delayed(_bootstrap_apply_func)(self,
+                        delayed(_bootstrap_apply_func)(data,
                                                        function, random_state=seeds[i], *args, **kwargs)
                         for i in range(n_samples))
         bootstrapped = Adjacency(bootstrapped)
@@ -870,19 +1311,21 @@ class Adjacency(object):
         '''
 
         stats = {}
+        data = self.to_dense()
         if isinstance(X, Adjacency):
             if X.square_shape()[0] != self.square_shape()[0]:
                 raise ValueError('Adjacency instances must be the same size.')
-            b, t, p, _, res = regression(X.data.T, self.data, mode=mode, **kwargs)
+            b, t, p, _, res = regression(X.to_dense().data.T, data.data, mode=mode,
+                                         **kwargs)
             stats['beta'], stats['t'], stats['p'], stats['residual'] = (b, t, p, res)
         elif isinstance(X, Design_Matrix):
             if X.shape[0] != len(self):
                 raise ValueError('Design matrix must have same number of observations as Adjacency')
-            b, t, p, df, res = regression(X, self.data, mode=mode, **kwargs)
+            b, t, p, df, res = regression(X, data.data, mode=mode, **kwargs)
             mode = 'ols'
-            stats['beta'], stats['t'], stats['p'] = [x for x in self[:3]]
+            stats['beta'], stats['t'], stats['p'] = [x for x in data[:3]]
             stats['beta'].data, stats['t'].data, stats['p'].data = b.squeeze(), t.squeeze(), p.squeeze()
-            stats['residual'] = self.copy()
+            stats['residual'] = data
             stats['residual'].data = res
         else:
             raise ValueError('X must be a Design_Matrix or Adjacency Instance.')
@@ -37,7 +37,7 @@ from nltools.mask import expand_mask
 from nltools.analysis import Roc
 from nilearn.input_data import NiftiMasker
 from nilearn.plotting import plot_stat_map
-from nilearn.image import resample_img, smooth_img
+from nilearn.image import resample_img, smooth_img, new_img_like
 from nilearn.masking import intersect_masks
 from nilearn.regions import connected_regions, connected_label_regions
 from nltools.utils import (set_algorithm,
@@ -50,12 +50,13 @@ from nltools.utils import (set_algorithm,
 from nltools.cross_validation import set_cv
 from nltools.plotting import scatterplot
 from nltools.stats import (pearson,
-                           fdr,
+                           adjust_pvalues,
                            threshold,
                            fisher_r_to_z,
                            transform_pairwise,
                            summarize_bootstrap,
                            procrustes,
+                           sliding_window_correlation,
                            find_spikes)
 from nltools.stats import regress as regression
 from .adjacency import Adjacency
@@ -114,7 +115,7 @@ class Brain_Data(object):
                     data = nib.load(download_nifti(data, data_dir=tmp_dir))
                 else:
                     data = nib.load(data)
-                self.data = self.nifti_masker.fit_transform(data)
+                self.data = self._mask_data(data)
             elif isinstance(data, list):
                 if isinstance(data[0], Brain_Data):
                     tmp = concatenate(data)
@@ -126,15 +127,14 @@ class Brain_Data(object):
                         self.data = []
                         for i in data:
                             if isinstance(i, six.string_types):
-                                self.data.append(self.nifti_masker.fit_transform(
-                                                 nib.load(i)))
+                                self.data.append(self._mask_data(nib.load(i)))
                             elif isinstance(i, nib.Nifti1Image):
-                                self.data.append(self.nifti_masker.fit_transform(i))
+                                self.data.append(self._mask_data(i))
                         self.data = np.concatenate(self.data)
                     else:
                         raise ValueError('Make sure all objects in the list are the same type.')
             elif isinstance(data, nib.Nifti1Image):
-                self.data = np.array(self.nifti_masker.fit_transform(data))
+                self.data = np.array(self._mask_data(data))
             else:
                 raise ValueError("data is not a nibabel instance")
 
@@ -342,10 +342,85 @@ class Brain_Data(object):
             out = np.sum(self.data)
         return out
 
-    def to_nifti(self):
-        """ Convert Brain_Data Instance into Nifti Object """
+    def _mask_index(self):
+        """ Get flat indices of voxels in the mask. These are cached until
+            the mask changes. Returns None if the mask can't be indexed
+            directly, in which case NiftiMasker is used instead.
+        """
+
+        mask_img = self.nifti_masker.mask_img
+        cache = getattr(self, '_mask_index_cache', None)
+        if cache is None or cache[0] is not mask_img:
+            index = None
+            if isinstance(mask_img, nib.Nifti1Image):
+                mask = np.asanyarray(mask_img.dataobj)
+                if mask.ndim == 4 and mask.shape[3] == 1:
+                    mask = mask[..., 0]
+                if mask.ndim == 3:
+                    index = np.flatnonzero(mask)
+            self._mask_index_cache = (mask_img, index)
+        return self._mask_index_cache[1]
+
+    def _mask_data(self, img):
+        """ Extract data within mask from a nibabel instance. Streams the
+            slab bounding the mask volume by volume when the image is already
+            in the space of the mask, otherwise uses NiftiMasker (e.g., to
+            resample). Matches NiftiMasker's output dtype and sets non-finite
+            values to 0.
+
+        Args:
+            img: (nib.Nifti1Image) 3D or 4D image
 
-        return self.nifti_masker.inverse_transform(self.data)
+        Returns:
+            data: (np.array) images by voxels array
+
+        """
+
+        index = self._mask_index()
+        mask_img = self.nifti_masker.mask_img
+        if (index is None or len(img.shape) not in [3, 4] or
+                img.shape[:3] != mask_img.shape[:3] or
+                not np.allclose(img.affine, mask_img.affine)):
+            return self.nifti_masker.fit_transform(img)
+
+        from nltools.file_reader import read_nifti_masked
+        return read_nifti_masked(img, mask_img)
+
+    def to_nifti(self, dtype=None):
+        """ Convert Brain_Data Instance into Nifti Object
+
+        Args:
+            dtype: datatype of output image; default is the dtype of
+                   Brain_Data.data
+
+        Returns:
+            nib.Nifti1Image
+
+        """
+
+        index = self._mask_index()
+        if index is None:
+            if not hasattr(self.nifti_masker, 'mask_img_'):
+                self.nifti_masker.fit()
+            data = self.data if dtype is None else self.data.astype(dtype)
+            return self.nifti_masker.inverse_transform(data)
+
+        mask_img = self.nifti_masker.mask_img
+        shape = mask_img.shape[:3]
+        data = np.asarray(self.data)
+        if dtype is None:
+            dtype = data.dtype
+        if data.ndim == 1:
+            out = np.zeros(np.prod(shape), dtype=dtype)
+            out[index] = data
+            out = out.reshape(shape)
+        elif data.ndim == 2:
+            out = np.zeros((np.prod(shape), data.shape[0]), dtype=dtype)
+            out[index] = data.T
+            out = out.reshape(shape + (data.shape[0],))
+        else:
+            raise ValueError('Brain_Data.data must be 1D or 2D.')
+        return new_img_like(mask_img, out, mask_img.affine)
 
     def write(self, file_name=None):
         """ Write out Brain_Data object to Nifti File.
@@ -476,7 +551,8 @@ class Brain_Data(object):
 
         Returns:
             out: dictionary of regression statistics in Brain_Data instances
-                {'beta','t','p','df','residual'}
+                {'beta','t','p','p_fdr','sigma','residual'}; p_fdr holds FDR
+                adjusted p-values across voxels for each regressor
 
         """
 
@@ -502,9 +578,11 @@ class Brain_Data(object):
         p_out = b_out.copy()
         sigma_out = b_out.copy()
         res_out = b_out.copy()
+        p_fdr_out = b_out.copy()
         b_out.data, t_out.data, p_out.data, sigma_out.data, res_out.data = (b, t, p, sigma_out, res)
+        p_fdr_out.data = adjust_pvalues(p, method='fdr')[0]
 
-        return {'beta': b_out, 't': t_out, 'p': p_out,
+        return {'beta': b_out, 't': t_out, 'p': p_out, 'p_fdr': p_fdr_out,
                 'sigma': sigma_out, 'residual': res_out}
 
     def ttest(self, threshold_dict=None):
@@ -512,12 +590,13 @@ class Brain_Data(object):
 
         Args:
             threshold_dict: (dict) a dictionary of threshold parameters
-                            {'unc':.001} or {'fdr':.05} or {'permutation':tcfe,
-                            n_permutation:5000}
+                            {'unc':.001} or {'fdr':.05} or {'holm':.05} or
+                            {'permutation':tcfe, n_permutation:5000}
 
         Returns:
             out: (dict) dictionary of regression statistics in Brain_Data
-                 instances {'t','p'}
+                 instances {'t','p'}, with 'thr_t' if thresholded and
+                 adjusted p-values 'p_fdr' or 'p_holm' for those thresholds
 
         """
 
@@ -572,14 +651,18 @@ class Brain_Data(object):
 
         if threshold_dict is not None:
             if isinstance(threshold_dict, dict):
+                out = {'t': t, 'p': p}
                 if 'unc' in threshold_dict:
                     thr = threshold_dict['unc']
-                elif 'fdr' in threshold_dict:
-                    thr = fdr(p.data, q=threshold_dict['fdr'])
+                elif 'fdr' in threshold_dict or 'holm' in threshold_dict:
+                    method = 'fdr' if 'fdr' in threshold_dict else 'holm'
+                    p_adj = p.copy()
+                    p_adj.data, thr = adjust_pvalues(
+                        p.data, method=method, alpha=threshold_dict[method])
+                    out['p_' + method] = p_adj
                 elif 'permutation' in threshold_dict:
                     thr = .05
-                thr_t = threshold(t, p, thr)
-                out = {'t': t, 'p': p, 'thr_t': thr_t}
+                out['thr_t'] = threshold(t, p, thr)
             else:
                 raise ValueError("threshold_dict is not a dictionary. "
                                  "Make sure it is in the form of {'unc': .001} "
@@ -739,6 +822,66 @@ class Brain_Data(object):
             raise ValueError('Method must be one of: correlation, dot_product, cosine')
         return flatten_array(pexp)
 
+    def seed_correlation(self, seeds, fisher_z=False, chunk_size=10000):
+        """ Correlate seed time series with every voxel.
+
+            The standardized seeds are multiplied with the data one chunk
+            of voxels at a time, and the voxel norms are computed from the
+            same chunk without a centered copy of it, so memory is bounded
+            by chunk_size.
+
+            Args:
+                seeds: (np.array, pd.DataFrame, nifti, Brain_Data) images by
+                       seeds time series, or a mask with a different integer
+                       for each seed ROI whose mean time series are used
+                fisher_z: (bool) return Fisher z transformed correlations
+                chunk_size: (int) number of voxels per matrix product;
+                            default 10000
+
+            Returns:
+                out: (Brain_Data) one correlation map per seed
+
+        """
+
+        if len(self.shape()) == 1:
+            raise ValueError('Seed correlation requires more than one image.')
+        if isinstance(seeds, (Brain_Data, nib.Nifti1Image)):
+            seeds = self.extract_roi(seeds).T
+        seeds = np.asarray(seeds, dtype=float)
+        seeds = seeds.reshape(seeds.shape[0], -1)
+        if seeds.shape[0] != self.shape()[0]:
+            raise ValueError('Seeds must have one value per image.')
+
+        # Centered seeds sum to zero, so the voxel means need not be removed
+        seeds = seeds - seeds.mean(axis=0)
+        seeds_norm = np.sqrt((seeds ** 2).sum(axis=0))
+        seeds = np.divide(seeds, seeds_norm, out=np.zeros_like(seeds),
+                          where=seeds_norm > 0)
+
+        n_images, n_voxels = self.shape()
+        r = np.empty((seeds.shape[1], n_voxels))
+        for start in range(0, n_voxels, chunk_size):
+            cols = slice(start, start + chunk_size)
+            chunk = self.data[:, cols]
+            # Centered sums of squares, accumulated in double precision
+            sumsq = np.einsum('ij,ij->j', chunk, chunk, dtype=np.float64)
+            var = sumsq - n_images * chunk.mean(axis=0, dtype=np.float64) ** 2
+            # Voxels constant up to round-off are left uncorrelated
+            inv_norm = np.zeros(len(var))
+            varies = var > n_images * np.finfo(float).eps * sumsq
+            inv_norm[varies] = 1 / np.sqrt(var[varies])
+            r[:, cols] = np.dot(seeds.T, chunk) * inv_norm
+        np.clip(r, -1, 1, out=r)
+        if fisher_z:
+            with np.errstate(divide='ignore'):
+                r = fisher_r_to_z(r)
+
+        out = self.__class__()
+        out.mask = deepcopy(self.mask)
+        out.nifti_masker = deepcopy(self.nifti_masker)
+        out.data = r[0] if r.shape[0] == 1 else r
+        return out
+
     def distance(self, method='euclidean', **kwargs):
         """ Calculate distance between images within a Brain_Data() instance.
 
@@ -1072,7 +1215,7 @@ class Brain_Data(object):
             sl = SearchLight(mask_img=self.mask, process_mask_img=process_mask_img, estimator=estimator, n_jobs=n_jobs, scoring=scoring, cv=cv, verbose=verbose, radius=radius)
             in_image = self.to_nifti()
             sl.fit(in_image, self.Y, groups=groups)
-            out = nib.Nifti1Image(sl.scores_, affine=self.nifti_masker.affine_)
+            out = nib.Nifti1Image(sl.scores_, affine=self.nifti_masker.mask_img.affine)
             out = Brain_Data(out, mask=self.mask)
         return out
 
@@ -1100,9 +1243,8 @@ class Brain_Data(object):
                                  "instance, or a valid file name.")
 
         masked = deepcopy(self)
-        nifti_masker = NiftiMasker(mask_img=mask)
-        masked.data = nifti_masker.fit_transform(self.to_nifti())
-        masked.nifti_masker = nifti_masker
+        masked.nifti_masker = NiftiMasker(mask_img=mask)
+        masked.data = masked._mask_data(self.to_nifti())
         if (len(masked.shape()) > 1) & (masked.shape()[0] == 1):
             masked.data = masked.data.flatten()
         return masked
@@ -1138,6 +1280,31 @@ class Brain_Data(object):
             out = np.array(out)
         return out
 
+    def sliding_window_correlation(self, mask, window, step=1,
+                                   taper='rectangular', tau=None):
+        ''' Compute the correlation between the mean time series of each pair
+            of ROIs in sliding windows (dynamic functional connectivity).
+            Window sums are updated incrementally as the window slides; see
+            nltools.stats.sliding_window_correlation.
+
+        Args:
+            mask: (nifti, Brain_Data) mask with a different integer for each
+                  ROI
+            window: (int) number of images in each window
+            step: (int) number of images between the starts of windows
+            taper: (str) weighting of images within each window;
+                   'rectangular' (default), 'hann', 'hamming' or
+                   'exponential'
+            tau: (float) decay of the exponential taper in images;
+                 default window / 3
+
+        Returns:
+            out: (Adjacency) one ROI by ROI similarity matrix per window
+
+        '''
+        return sliding_window_correlation(self.extract_roi(mask).T, window,
+                                          step=step, taper=taper, tau=tau)
+
     def icc(self, icc_type='icc2'):
         ''' Calculate intraclass correlation coefficient for data within
             Brain_Data class
@@ -1482,19 +1649,35 @@ class Brain_Data(object):
 
         return Brain_Data(regions, mask=self.mask)
 
-    def transform_pairwise(self):
-        ''' Extract brain connected regions into separate regions.
+    def transform_pairwise(self, batch_size=None):
+        ''' Transform Brain_Data instance into pairwise differences with
+            balanced labels for ranking models (see
+            nltools.stats.transform_pairwise).
 
         Args:
+            batch_size: (int) if provided, return a generator of Brain_Data
+                        instances each containing at most batch_size pairs;
+                        default None
 
         Returns:
             Brain_Data: Brain_Data instance tranformed into pairwise comparisons
         '''
-        out = self.copy()
-        out.data, new_Y = transform_pairwise(self.data, self.Y)
-        out.Y = pd.DataFrame(new_Y)
-        out.Y.replace(-1, 0, inplace=True)
-        return out
+
+        y = np.array(self.Y)
+        if y.ndim == 2 and y.shape[1] == 1:
+            y = y.ravel()
+
+        def _to_brain_data(data, new_Y):
+            out = self.empty()
+            out.data = data
+            out.Y = pd.DataFrame(new_Y)
+            out.Y.replace(-1, 0, inplace=True)
+            return out
+
+        if batch_size is not None:
+            return (_to_brain_data(data, new_Y) for data, new_Y in
+                    transform_pairwise(self.data, y, batch_size=batch_size))
+        return _to_brain_data(*transform_pairwise(self.data, y))
 
     def bootstrap(self, function, n_samples=5000, save_weights=False,
                   n_jobs=-1, random_state=None, *args, **kwargs):
@@ -1655,7 +1838,8 @@ class Brain_Data(object):
         '''
         return Brain_Data(smooth_img(self.to_nifti(), fwhm))
 
-    def find_spikes(self, global_spike_cutoff=3, diff_spike_cutoff=3):
+    def find_spikes(self, global_spike_cutoff=3, diff_spike_cutoff=3,
+                    sampling_freq=None):
         '''Function to identify spikes from Time Series Data
 
             Args:
@@ -1663,12 +1847,15 @@ class Brain_Data(object):
                                      in standard deviations, None indicates do not calculate.
                 diff_spike_cutoff: (int,None) cutoff to identify spikes in average frame difference
                                      in standard deviations, None indicates do not calculate.
+                sampling_freq: (float) sampling frequency of data in hertz;
+                               default None
             Returns:
-                pandas dataframe with spikes as indicator variables
+                Design_Matrix with spikes as indicator variables
         '''
         return find_spikes(self,
                             global_spike_cutoff=global_spike_cutoff,
-                            diff_spike_cutoff=diff_spike_cutoff)
+                            diff_spike_cutoff=diff_spike_cutoff,
+                            sampling_freq=sampling_freq)
 
 
 class Groupby(object):
@@ -4,13 +4,15 @@ NeuroLearn File Reading Tools
 
 '''
 
-__all__ = ['onsets_to_dm']
+__all__ = ['onsets_to_dm', 'read_nifti_masked']
 __author__ = ["Eshin Jolly"]
 __license__ = "MIT"
 
 import pandas as pd
 import numpy as np
 import six
+import nibabel as nib
+import time
 from nltools.data import Design_Matrix
 import warnings
 
@@ -93,3 +95,92 @@ def onsets_to_dm(F, sampling_freq, run_length, header='infer', sort=False, keep_
             out_dm = out[0]
 
     return out_dm
+
+
+def _read_box(dataobj, box, index, n_images, n_volumes):
+    """ Read the voxels at Fortran order flat indices of the box of a 3D or
+        4D array proxy, n_volumes at a time."""
+    if len(dataobj.shape) == 3:
+        return np.asanyarray(dataobj[box]).ravel(order='F')[index][np.newaxis, :]
+    data = None
+    for start in range(0, n_images, n_volumes):
+        stop = min(start + n_volumes, n_images)
+        slab = np.asanyarray(dataobj[box + (slice(start, stop),)])
+        if data is None:
+            dtype = slab.dtype if slab.dtype.kind == 'f' else np.float32
+            data = np.empty((n_images, len(index)), dtype=dtype)
+        for i in range(stop - start):
+            data[start + i] = slab[..., i].ravel(order='F')[index]
+    return data
+
+
+def read_nifti_masked(img, mask, n_volumes=1, verbose=False):
+    """
+    Read the voxels within a mask from a 3D or 4D nifti image with bounded memory. Only the slab of the image bounding the mask is read, so for uncompressed files the planes outside of the mask are never touched. Volumes are streamed through the nibabel dataobj proxy n_volumes at a time, so peak memory is one slab of volumes plus the output. Image and mask must be in the same space; use NiftiMasker to resample otherwise.
+
+    Args:
+        img (filepath/nib.Nifti1Image): 3D or 4D image to read
+        mask (filepath/nib.Nifti1Image/np.ndarray): 3D mask in the same space as img
+        n_volumes (int): number of volumes to read at a time; defaults to 1
+        verbose (bool): print throughput in MB/s; defaults to False
+
+    Returns:
+        data (np.array): images by voxels array. Floating point images keep their dtype, other images are cast to float32. Non-finite values are set to 0.
+
+    """
+    if isinstance(img, six.string_types):
+        img = nib.load(img)
+    if isinstance(mask, six.string_types):
+        mask = nib.load(mask)
+    if isinstance(mask, nib.spatialimages.SpatialImage):
+        mask = np.asanyarray(mask.dataobj)
+    mask = np.asarray(mask)
+    if mask.ndim == 4 and mask.shape[3] == 1:
+        mask = mask[..., 0]
+    if mask.ndim != 3:
+        raise ValueError('mask must be 3D.')
+    if len(img.shape) not in [3, 4] or img.shape[:3] != mask.shape:
+        raise ValueError('img and mask must have the same 3D shape.')
+    if n_volumes < 1:
+        raise ValueError('n_volumes must be at least 1.')
+
+    # Bounding box of the mask and the mask within it
+    nonzero = np.nonzero(mask)
+    n_vox = len(nonzero[0])
+    if n_vox:
+        box = tuple(slice(x.min(), x.max() + 1) for x in nonzero)
+    else:
+        box = tuple(slice(0, 0) for x in nonzero)
+    mask_box = mask[box] != 0
+    box_size = mask_box.size
+    # nibabel returns Fortran ordered arrays, so gather voxels through
+    # Fortran order flat indices listed in the C order NiftiMasker uses
+    index = np.ravel_multi_index(np.nonzero(mask_box), mask_box.shape,
+                                 order='F')
+
+    n_images = img.shape[3] if len(img.shape) == 4 else 1
+    itemsize = img.get_data_dtype().itemsize
+    start_time = time.time()
+    proxy = img.dataobj
+    if (isinstance(proxy, nib.arrayproxy.ArrayProxy) and
+            isinstance(proxy.file_like, six.string_types)):
+        # Stream through one file handle, closed once reading finishes, so
+        # compressed files are decompressed once rather than once per slab.
+        # The proxy keeps the image's own layout and scaling.
+        with nib.openers.ImageOpener(proxy.file_like) as fileobj:
+            proxy = nib.arrayproxy.ArrayProxy(
+                fileobj, (proxy.shape, proxy.dtype, proxy.offset,
+                          proxy.slope, proxy.inter))
+            data = _read_box(proxy, box, index, n_images, n_volumes)
+    else:
+        data = _read_box(proxy, box, index, n_images, n_volumes)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float32)
+    data[~np.isfinite(data)] = 0
+    elapsed = time.time() - start_time
+
+    if verbose:
+        n_mb = box_size * n_images * itemsize / 1e6
+        print('Read %.1f MB in %.2f s (%.1f MB/s)' %
+              (n_mb, elapsed, n_mb / max(elapsed, 1e-9)))
+    return data
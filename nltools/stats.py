@@ -11,6 +11,7 @@ Tools to help with statistical analyses.
 __all__ = ['pearson',
            'zscore',
            'fdr',
+           'adjust_pvalues',
            'holm_bonf',
            'threshold',
            'multi_threshold',
@@ -31,31 +32,37 @@ __all__ = ['pearson',
            'procrustes',
            'procrustes_distance',
            'align',
+           'isc',
+           'isfc',
+           'seed_correlation',
+           'sliding_window_correlation',
            'find_spikes',
            'correlation',
            'distance_correlation',
+           'distance_correlation_batch',
            'transform_pairwise',
            'double_center',
            'u_center',]
 
 import numpy as np
 import pandas as pd
-from scipy.stats import pearsonr, spearmanr, kendalltau, norm, ttest_1samp
+from scipy.stats import (pearsonr, spearmanr, kendalltau, norm, ttest_1samp,
+                         rankdata)
 from scipy.stats import t as t_dist
-from scipy.spatial.distance import squareform, pdist
+from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from copy import deepcopy
 import nibabel as nib
 from scipy.interpolate import interp1d
 import warnings
-import itertools
 from joblib import Parallel, delayed
 import six
-from .utils import attempt_to_import, check_square_numpy_matrix
+from .utils import (attempt_to_import, check_square_numpy_matrix,
+                    check_brain_data)
 from .external.srm import SRM, DetSRM
-from scipy.linalg import orthogonal_procrustes
-from scipy.spatial import procrustes as procrust
+from scipy.linalg import orthogonal_procrustes, get_blas_funcs
 from sklearn.utils import check_random_state
-from sklearn.metrics import pairwise_distances
 
 MAX_INT = np.iinfo(np.int32).max
 
@@ -95,53 +102,94 @@ def zscore(df):
         raise ValueError("Data is not a Pandas DataFrame or Series instance")
 
 
+def adjust_pvalues(p, method='fdr', alpha=.05):
+    """ Compute adjusted p-values and the corresponding p-value thresholds
+    for each row of a 2D array of p-values (e.g., many contrasts or subjects)
+    in one sorted pass. NaN p-values are ignored and not counted as tests;
+    p-values of 0 are valid tests.
+
+    Args:
+        p: (np.array) 1D vector or 2D array of p-values, one set per row
+        method: (str) 'fdr' for Benjamini-Hochberg false discovery rate or
+                'holm' for Holm-Bonferroni step-down
+        alpha: (float) false discovery rate or family-wise alpha level
+
+    Returns:
+        adjusted: (np.array) adjusted p-values with the same shape as p
+        thr: (float/np.array) largest p-value significant at alpha; -1 if
+             none are. One threshold per row for 2D p.
+
+    """
+
+    if not isinstance(p, np.ndarray):
+        raise ValueError('Make sure vector of p-values is a numpy array')
+    if p.ndim not in [1, 2]:
+        raise ValueError('p must be 1D or 2D.')
+    if method not in ['fdr', 'holm']:
+        raise ValueError("method must be ['fdr', 'holm']")
+
+    p_2d = np.atleast_2d(p).astype(float)
+    n_rows, n_cols = p_2d.shape
+    order = np.argsort(p_2d, axis=1)
+    rows = np.arange(n_rows)[:, np.newaxis]
+    s = p_2d[rows, order]
+    valid = ~np.isnan(s)
+    n_tests = valid.sum(axis=1)[:, np.newaxis]
+    rank = np.arange(1, n_cols + 1)[np.newaxis, :]
+
+    # NaNs are sorted last, so fill them to leave the running min/max alone
+    if method == 'fdr':
+        adjusted = np.where(valid, s * n_tests / rank, np.inf)
+        adjusted = np.minimum.accumulate(adjusted[:, ::-1], axis=1)[:, ::-1]
+    else:
+        adjusted = np.where(valid, s * (n_tests - rank + 1), -np.inf)
+        adjusted = np.maximum.accumulate(adjusted, axis=1)
+    adjusted = np.where(valid, np.minimum(adjusted, 1), np.nan)
+
+    significant = valid & (adjusted <= alpha)
+    thr = np.where(significant.any(axis=1),
+                   np.max(np.where(significant, s, -np.inf), axis=1), -1)
+
+    out = np.empty_like(adjusted)
+    out[rows, order] = adjusted
+    if p.ndim == 1:
+        return out[0], thr[0]
+    return out, thr
+
+
 def fdr(p, q=.05):
     """ Determine FDR threshold given a p value array and desired false
     discovery rate q. Written by Tal Yarkoni
 
     Args:
-        p: (np.array) vector of p-values (only considers non-zero p-values)
+        p: (np.array) vector of p-values, or 2D array with one set of
+           p-values per row (NaN p-values are ignored)
         q: (float) false discovery rate level
 
     Returns:
         fdr_p: (float) p-value threshold based on independence or positive
-                dependence
+                dependence; one per row for 2D p
 
     """
 
-    if not isinstance(p, np.ndarray):
-        raise ValueError('Make sure vector of p-values is a numpy array')
-
-    s = np.sort(p)
-    nvox = p.shape[0]
-    null = np.array(range(1, nvox + 1), dtype='float') * q / nvox
-    below = np.where(s <= null)[0]
-    fdr_p = s[max(below)] if len(below) else -1
-    return fdr_p
+    return adjust_pvalues(p, method='fdr', alpha=q)[1]
 
 
 def holm_bonf(p, alpha=.05):
     """ Compute corrected p-values based on the Holm-Bonferroni method, i.e. step-down procedure applying iteratively less correction to highest p-values. A bit more conservative than fdr, but much more powerful thanvanilla bonferroni.
 
     Args:
-        p: (np.array) vector of p-values
+        p: (np.array) vector of p-values, or 2D array with one set of
+           p-values per row (NaN p-values are ignored)
         alpha: (float) alpha level
 
     Returns:
         bonf_p: (float) p-value threshold based on bonferroni
-                step-down procedure
+                step-down procedure; one per row for 2D p
 
     """
 
-    if not isinstance(p, np.ndarray):
-        raise ValueError('Make sure vector of p-values is a numpy array')
-
-    s = np.sort(p)
-    nvox = p.shape[0]
-    null = .05 / (nvox - np.arange(1, nvox + 1) + 1)
-    below = np.where(s <= null)[0]
-    bonf_p = s[max(below)] if len(below) else -1
-    return bonf_p
+    return adjust_pvalues(p, method='holm', alpha=alpha)[1]
 
 
 def threshold(stat, p, thr=.05):
@@ -223,88 +271,114 @@ def multi_threshold(t_map, p_map, thresh):
     return Brain_Data(nib.Nifti1Image(pos_out, affine))
 
 
-def winsorize(data, cutoff=None, replace_with_cutoff=True):
+def winsorize(data, cutoff=None, replace_with_cutoff=True, inplace=False):
     ''' Winsorize a Pandas DataFrame or Series with the largest/lowest value not considered outlier
 
         Args:
-            data: (pd.DataFrame, pd.Series) data to winsorize
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) data to
+                  winsorize; each column is winsorized separately
             cutoff: (dict) a dictionary with keys {'std':[low,high]} or
                     {'quantile':[low,high]}
             replace_with_cutoff: (bool) If True, replace outliers with cutoff.
                                  If False, replaces outliers with closest
                                  existing values; (default: False)
+            inplace: (bool) modify floating point data in place rather than
+                     returning a copy; (default: False)
         Returns:
-            out: (pd.DataFrame, pd.Series) winsorized data
+            out: (pd.DataFrame, pd.Series, np.array, Brain_Data) winsorized data
     '''
-    return _transform_outliers(data, cutoff, replace_with_cutoff=replace_with_cutoff, method='winsorize')
+    return _transform_outliers(data, cutoff, replace_with_cutoff=replace_with_cutoff, method='winsorize', inplace=inplace)
 
 
-def trim(data, cutoff=None):
+def trim(data, cutoff=None, inplace=False):
     ''' Trim a Pandas DataFrame or Series by replacing outlier values with NaNs
 
         Args:
-            data: (pd.DataFrame, pd.Series) data to trim
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) data to
+                  trim; each column is trimmed separately
             cutoff: (dict) a dictionary with keys {'std':[low,high]} or
                     {'quantile':[low,high]}
+            inplace: (bool) modify floating point data in place rather than
+                     returning a copy; (default: False)
         Returns:
-            out: (pd.DataFrame, pd.Series) trimmed data
+            out: (pd.DataFrame, pd.Series, np.array, Brain_Data) trimmed data
     '''
-    return _transform_outliers(data, cutoff, replace_with_cutoff=None, method='trim')
+    return _transform_outliers(data, cutoff, replace_with_cutoff=None, method='trim', inplace=inplace)
 
 
-def _transform_outliers(data, cutoff, replace_with_cutoff, method):
+def _transform_outliers(data, cutoff, replace_with_cutoff, method,
+                        inplace=False):
     ''' This function is not exposed to user but is called by either trim
-        or winsorize.
+        or winsorize. Cutoffs are computed for all columns at once and
+        applied to the underlying array.
 
         Args:
-            data: (pd.DataFrame, pd.Series) data to transform
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) data to
+                  transform
             cutoff: (dict) a dictionary with keys {'std':[low,high]} or
                     {'quantile':[low,high]}
             replace_with_cutoff: (bool) If True, replace outliers with cutoff.
                                         If False, replaces outliers with closest
                                         existing values. (default: False)
             method: 'winsorize' or 'trim'
+            inplace: (bool) modify floating point data in place
 
         Returns:
-            out: (pd.DataFrame, pd.Series) transformed data
+            out: (pd.DataFrame, pd.Series, np.array, Brain_Data) transformed data
     '''
-    df = data.copy()  # To not overwrite data make a copy
-
-    def _transform_outliers_sub(data, cutoff, replace_with_cutoff, method='trim'):
-        if not isinstance(data, pd.Series):
-            raise ValueError('Make sure that you are applying winsorize to a pandas dataframe or series.')
-        if isinstance(cutoff, dict):
-            # calculate cutoff values
-            if 'quantile' in cutoff:
-                q = data.quantile(cutoff['quantile'])
-            elif 'std' in cutoff:
-                std = [data.mean()-data.std()*cutoff['std'][0], data.mean()+data.std()*cutoff['std'][1]]
-                q = pd.Series(index=cutoff['std'], data=std)
-            # if replace_with_cutoff is false, replace with true existing values closest to cutoff
-            if method == 'winsorize':
-                if not replace_with_cutoff:
-                    q.iloc[0] = data[data > q.iloc[0]].min()
-                    q.iloc[1] = data[data < q.iloc[1]].max()
+    from nltools.data import Brain_Data
+
+    if not isinstance(data, (pd.DataFrame, pd.Series, np.ndarray, Brain_Data)):
+        raise ValueError('Data must be a pandas DataFrame or Series, numpy '
+                         'array, or Brain_Data instance')
+    if not isinstance(cutoff, dict) or not ('quantile' in cutoff or
+                                            'std' in cutoff):
+        raise ValueError('cutoff must be a dictionary with quantile or std keys.')
+
+    if not inplace:
+        if isinstance(data, Brain_Data):
+            data = data.copy()
+            data.data = data.data.astype(float)
+        elif isinstance(data, np.ndarray):
+            data = np.array(data, dtype=float)
         else:
-            raise ValueError('cutoff must be a dictionary with quantile or std keys.')
-        if method == 'winsorize':
-            if isinstance(q, pd.Series) and len(q) == 2:
-                data[data < q.iloc[0]] = q.iloc[0]
-                data[data > q.iloc[1]] = q.iloc[1]
-        elif method == 'trim':
-            data[data < q.iloc[0]] = np.nan
-            data[data > q.iloc[1]] = np.nan
-        return data
-
-    # transform each column if a dataframe, if series just transform data
-    if isinstance(df, pd.DataFrame):
-        for col in df.columns:
-            df.loc[:, col] = _transform_outliers_sub(df.loc[:, col], cutoff=cutoff, replace_with_cutoff=replace_with_cutoff, method=method)
-        return df
-    elif isinstance(df, pd.Series):
-        return _transform_outliers_sub(df, cutoff=cutoff, replace_with_cutoff=replace_with_cutoff, method=method)
+            data = data.astype(float)
+    if isinstance(data, Brain_Data):
+        values = data.data
+    elif isinstance(data, np.ndarray):
+        values = data
+    else:
+        values = data.values
+    if values.dtype.kind != 'f':
+        raise ValueError('Data must be floating point to transform in place.')
+
+    # calculate cutoff values for all columns
+    if 'quantile' in cutoff:
+        quantile = np.nanquantile if np.isnan(values).any() else np.quantile
+        low, high = quantile(values, cutoff['quantile'], axis=0)
     else:
-        raise ValueError('Data must be a pandas DataFrame or Series')
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0, ddof=1)
+        low = mean - std * cutoff['std'][0]
+        high = mean + std * cutoff['std'][1]
+    # if replace_with_cutoff is false, replace with true existing values closest to cutoff
+    if method == 'winsorize' and not replace_with_cutoff:
+        low = np.where(values > low, values, np.inf).min(axis=0)
+        high = np.where(values < high, values, -np.inf).max(axis=0)
+        low = np.where(np.isinf(low), np.nan, low)
+        high = np.where(np.isinf(high), np.nan, high)
+
+    if method == 'winsorize':
+        np.copyto(values, low, where=values < low)
+        np.copyto(values, high, where=values > high)
+    elif method == 'trim':
+        np.copyto(values, np.nan, where=(values < low) | (values > high))
+
+    if isinstance(data, pd.Series):
+        data.iloc[:] = values
+    elif isinstance(data, pd.DataFrame):
+        data.iloc[:, :] = values
+    return data
 
 
 def calc_bpm(beat_interval, sampling_freq):
@@ -321,13 +395,56 @@ def calc_bpm(beat_interval, sampling_freq):
     return 60*sampling_freq*(1/(beat_interval))
 
 
+def _timeseries_array(data):
+    ''' Get time series data as a samples by features array along with a
+        function converting a resampled array back to the type of data.
+
+        Args:
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) time series
+                  with samples on the first axis; non-numeric DataFrame
+                  columns are dropped
+
+        Returns:
+            values: (np.array) samples by features array
+            convert: (function) converts a resampled array to type of data
+
+    '''
+    from nltools.data import Brain_Data
+
+    if isinstance(data, Brain_Data):
+        def convert(x):
+            out = data.__class__()
+            out.mask = deepcopy(data.mask)
+            out.nifti_masker = deepcopy(data.nifti_masker)
+            out.data = x
+            return out
+        return np.atleast_2d(data.data), convert
+    elif isinstance(data, pd.Series):
+        return (data.values[:, np.newaxis],
+                lambda x: pd.Series(x[:, 0], name=data.name))
+    elif isinstance(data, pd.DataFrame):
+        numeric_data = data._get_numeric_data()
+        if data.shape[1] != numeric_data.shape[1]:
+            warnings.warn('Dropping %s non-numeric columns' % (data.shape[1] - numeric_data.shape[1]), UserWarning)
+        return (numeric_data.values,
+                lambda x: pd.DataFrame(x, columns=numeric_data.columns))
+    elif isinstance(data, np.ndarray) and data.ndim in [1, 2]:
+        return (data.reshape(data.shape[0], -1),
+                lambda x: x.reshape((x.shape[0],) + data.shape[1:]))
+    else:
+        raise ValueError('Data must by a pandas DataFrame or Series instance, '
+                         '1D or 2D numpy array, or Brain_Data instance.')
+
+
 def downsample(data, sampling_freq=None, target=None, target_type='samples',
                method='mean'):
     ''' Downsample pandas to a new target frequency or number of samples
-        using averaging.
+        using averaging. Consecutive blocks of samples are averaged for all
+        columns at once with np.add.reduceat.
 
         Args:
-            data: (pd.DataFrame, pd.Series) data to downsample
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) data to
+                  downsample along the first axis
             sampling_freq:  (float) Sampling frequency of data in hertz
             target: (float) downsampling target
             target_type: type of target can be [samples,seconds,hz]
@@ -335,12 +452,10 @@ def downsample(data, sampling_freq=None, target=None, target_type='samples',
                     default: mean
 
         Returns:
-            out: (pd.DataFrame, pd.Series) downsmapled data
+            out: (pd.DataFrame, pd.Series, np.array, Brain_Data) downsmapled data
 
     '''
 
-    if not isinstance(data, (pd.DataFrame, pd.Series)):
-        raise ValueError('Data must by a pandas DataFrame or Series instance.')
     if not (method == 'median') | (method == 'mean'):
         raise ValueError("Metric must be either 'mean' or 'median' ")
 
@@ -354,21 +469,38 @@ def downsample(data, sampling_freq=None, target=None, target_type='samples',
         raise ValueError('Make sure target_type is "samples", "seconds", '
                          ' or "hz".')
 
-    idx = np.sort(np.repeat(np.arange(1, data.shape[0]/n_samples, 1), n_samples))
-    # if data.shape[0] % n_samples:
-    if data.shape[0] > len(idx):
-        idx = np.concatenate([idx, np.repeat(idx[-1]+1, data.shape[0]-len(idx))])
-    if method == 'mean':
-        return data.groupby(idx).mean().reset_index(drop=True)
-    elif method == 'median':
-        return data.groupby(idx).median().reset_index(drop=True)
+    values, convert = _timeseries_array(data)
+
+    # Sample i falls in block floor(i / n_samples)
+    if np.isclose(n_samples, np.round(n_samples)):
+        n_samples = int(np.round(n_samples))
+    block = np.floor(np.arange(values.shape[0]) / n_samples).astype(int)
+    starts = np.flatnonzero(np.diff(block, prepend=-1))
+    sizes = np.diff(np.append(starts, values.shape[0]))
+    func = np.mean if method == 'mean' else np.median
+    if np.all(sizes[:-1] == sizes[0]):
+        # Equal sized blocks except for a shorter last block
+        n_full = int(np.sum(sizes == sizes[0]))
+        out = func(values[:n_full * sizes[0]].reshape(
+            n_full, sizes[0], values.shape[1]), axis=1)
+        if n_full < len(starts):
+            out = np.vstack([out, func(values[starts[-1]:], axis=0)])
+    elif method == 'mean':
+        out = np.add.reduceat(values.astype(float), starts, axis=0)
+        out /= sizes[:, np.newaxis]
+    else:
+        out = np.array([np.median(x, axis=0) for x in
+                        np.split(values, starts[1:])])
+    return convert(out)
 
 
 def upsample(data, sampling_freq=None, target=None, target_type='samples', method='linear'):
-    ''' Upsample pandas to a new target frequency or number of samples using interpolation.
+    ''' Upsample pandas to a new target frequency or number of samples using
+        interpolation. All columns are interpolated in one call.
 
         Args:
-            data: (pd.DataFrame, pd.Series) data to upsample
+            data: (pd.DataFrame, pd.Series, np.array, Brain_Data) data to
+                  upsample along the first axis
                   (Note: will drop non-numeric columns from DataFrame)
             sampling_freq:  Sampling frequency of data in hertz
             target: (float) upsampling target
@@ -378,7 +510,7 @@ def upsample(data, sampling_freq=None, target=None, target_type='samples', metho
                           refer to a spline interpolation of zeroth, first,
                           second or third order  (default: linear)
         Returns:
-            upsampled pandas object
+            upsampled data of the same type as data
 
     '''
 
@@ -395,23 +527,13 @@ def upsample(data, sampling_freq=None, target=None, target_type='samples', metho
     else:
         raise ValueError('Make sure target_type is "samples", "seconds", or "hz".')
 
-    orig_spacing = np.arange(0, data.shape[0], 1)
-    new_spacing = np.arange(0, data.shape[0]-1, n_samples)
+    values, convert = _timeseries_array(data)
 
-    if isinstance(data, pd.Series):
-        interpolate = interp1d(orig_spacing, data, kind=method)
-        return interpolate(new_spacing)
-    elif isinstance(data, pd.DataFrame):
-        numeric_data = data._get_numeric_data()
-        if data.shape[1] != numeric_data.shape[1]:
-            warnings.warn('Dropping %s non-numeric columns' % (data.shape[1] - numeric_data.shape[1]), UserWarning)
-        out = pd.DataFrame(columns=numeric_data.columns, index=None)
-        for i, x in numeric_data.iteritems():
-            interpolate = interp1d(orig_spacing, x, kind=method)
-            out.loc[:, i] = interpolate(new_spacing)
-        return out
-    else:
-        raise ValueError('Data must by a pandas DataFrame or Series instance.')
+    orig_spacing = np.arange(0, values.shape[0], 1)
+    new_spacing = np.arange(0, values.shape[0]-1, n_samples)
+
+    interpolate = interp1d(orig_spacing, values, kind=method, axis=0)
+    return convert(interpolate(new_spacing))
 
 
 def fisher_r_to_z(r):
@@ -443,123 +565,514 @@ def correlation(data1, data2, metric='pearson'):
     return func(data1, data2)
 
 
-def _permute_sign(data, random_state=None):
+def _permute_sign(data, n_permute, random_state=None):
+    """ Null distribution of the mean under random sign flips, computed as a
+        (n_permute x n) sign matrix times the data.
+    """
     random_state = check_random_state(random_state)
-    return np.mean(data*random_state.choice([1, -1], len(data)))
+    signs = random_state.randint(2, size=(n_permute, data.shape[0]))
+    signs = (2 * signs - 1).astype(data.dtype)
+    return np.dot(signs, data) / data.shape[0]
 
 
-def _permute_group(data, random_state=None):
+def _group_stat(sum1, sumsq1, n1, total, totalsq, n2, welch=False):
+    """ Mean difference or Welch t between two groups from the sum and sum
+        of squares of group 1 and of both groups combined.
+    """
+    mean1 = sum1 / n1
+    mean2 = (total - sum1) / n2
+    if not welch:
+        return mean1 - mean2
+    var1 = (sumsq1 - n1 * mean1 ** 2) / (n1 - 1)
+    var2 = (totalsq - sumsq1 - n2 * mean2 ** 2) / (n2 - 1)
+    return (mean1 - mean2) / np.sqrt(var1 / n1 + var2 / n2)
+
+
+def _permute_group(data, n1, n_permute, welch=False, random_state=None):
+    """ Null distribution of the group difference under random relabeling.
+        Labels are permuted as an index matrix and group 1 sums are computed
+        as an indicator matrix times the data.
+    """
     random_state = check_random_state(random_state)
-    perm_label = random_state.permutation(data['Group'])
-    return (np.mean(data.loc[perm_label == 1, 'Values']) - np.mean(data.loc[perm_label == 0, 'Values']))
-
-
-def _permute_func(data1, data2, metric, random_state=None):
-    """ Helper function for matrix_permutation.
-        Can take a functon, that would be repeated for calculation.
+    n = data.shape[0]
+    perm_ix = np.argsort(random_state.rand(n_permute, n), axis=1)[:, :n1]
+    group1 = np.zeros((n_permute, n), dtype=data.dtype)
+    group1[np.arange(n_permute)[:, np.newaxis], perm_ix] = 1
+    sumsq1 = np.dot(group1, data ** 2) if welch else None
+    return _group_stat(np.dot(group1, data), sumsq1, n1, data.sum(axis=0),
+                       (data ** 2).sum(axis=0), n - n1, welch=welch)
+
+
+def _permute_matrix(data1, data2, metric, n_permute, symmetric=True,
+                    random_state=None):
+    """ Helper function for matrix_permutation. Permutes the rows and
+        columns of the square matrix data2 together, gathering the upper
+        triangle of each permutation with index arrays.
         Args:
-            data1: (np.array) squareform matrix
-            data2: flattened np array (same size upper triangle of data1)
-            metric: similarity/distance function from scipy.stats (e.g., spearman, pearson, kendall etc)
+            data1: (np.array) upper triangles (n_edges x n_targets) prepared
+                   by _correlation_ranks
+            data2: (np.array) square matrix; if symmetric, with its upper
+                   triangle prepared by _correlation_ranks, which commutes
+                   with permutation
+            metric: (str) type of association metric ['spearman','pearson',
+                    'kendall']
+            n_permute: (int) number of permutations
+            symmetric: (bool) whether data2 is symmetric; otherwise each
+                       permuted upper triangle is prepared separately
             random_state: random_state instance for permutation
         Returns:
-            r: r value of function
+            r: (np.array) n_permute x n_targets correlations
     """
     random_state = check_random_state(random_state)
+    rows, cols = np.triu_indices(data2.shape[0], k=1)
+    perm_ix = np.argsort(random_state.rand(n_permute, data2.shape[0]), axis=1)
+    permuted = data2[perm_ix[:, rows], perm_ix[:, cols]]
+    if not symmetric:
+        permuted = _correlation_ranks(permuted.T, metric).T
+    if metric == 'kendall':
+        return np.column_stack([_kendall_tau(x, permuted) for x in data1.T])
+    return np.dot(permuted, data1)
+
+
+def _correlation_ranks(data, metric):
+    """ Transform data once so that correlations under permutation reduce to
+        dot products (pearson, spearman) or comparisons of dense integer
+        ranks (kendall). Columns of 2D data are transformed separately.
+    """
+    data = np.asarray(data, dtype=float)
+    if metric == 'kendall':
+        return (rankdata(data, method='dense', axis=0) - 1).astype(int)
+    if metric == 'spearman':
+        data = rankdata(data, axis=0)
+    elif metric != 'pearson':
+        raise ValueError('metric must be "spearman" or "pearson" or "kendall"')
+    data = data - data.mean(axis=0)
+    return data / np.sqrt((data ** 2).sum(axis=0))
 
-    data_row_id = range(data1.shape[0])
-    permuted_ix = random_state.choice(data_row_id,
-                                      size=len(data_row_id))
-    new_fmri_dist = data1.iloc[permuted_ix, permuted_ix].values
-    new_fmri_dist = new_fmri_dist[np.triu_indices(new_fmri_dist.shape[0], k=1)]
-    return correlation(new_fmri_dist, data2, metric=metric)[0]
+
+def _count_inversions(data):
+    """ Count pairs i < j with data[i] > data[j] in each row of data, an
+        integer array with values in [0, n), by a bottom-up merge sort
+        vectorized over rows.
+    """
+    n_rows, n = data.shape
+    size = 1 << int(np.ceil(np.log2(max(n, 2))))
+    # Padding with the largest value at the end adds no inversions
+    data = np.concatenate([data, np.full((n_rows, size - n), n)], axis=1)
+    count = np.zeros(n_rows, dtype=np.int64)
+    width = 1
+    while width < size:
+        blocks = data.reshape(n_rows, size // (2 * width), 2 * width)
+        # Merge the sorted halves of each block. As the merge is stable, the
+        # k-th right element lands after the k left elements before it and
+        # after the left elements less than or equal to it, so the sum of
+        # right positions gives the number of (left > right) pairs.
+        order = np.argsort(blocks, axis=2, kind='stable')
+        right_pos = np.where(order >= width, np.arange(2 * width), 0)
+        n_le = right_pos.sum(axis=2) - width * (width - 1) // 2
+        count += (width * width - n_le).sum(axis=1)
+        data = np.take_along_axis(blocks, order, axis=2).reshape(n_rows, size)
+        width *= 2
+    return count
+
+
+def _tied_pairs(data):
+    """ Number of tied pairs in each row of a row-sorted array. """
+    index = np.arange(data.shape[1])
+    new_run = np.ones(data.shape, dtype=bool)
+    new_run[:, 1:] = data[:, 1:] != data[:, :-1]
+    run_start = np.maximum.accumulate(np.where(new_run, index, 0), axis=1)
+    return (index - run_start).sum(axis=1)
+
+
+def _kendall_tau(x, y):
+    """ Kendall's tau-b between x and each row of y in O(n log n) per row.
+        x (n,) and y (n_rows, n) are dense integer ranks starting at 0, as
+        returned by _correlation_ranks. Matches scipy.stats.kendalltau.
+    """
+    n = len(x)
+    if not len(y):
+        return np.zeros(0)
+    # Sort each row by x and then y, so ties in x are never discordant
+    keys = np.sort(x[np.newaxis, :].astype(np.int64) * n + y, axis=1)
+    n_pairs = n * (n - 1) / 2
+    x_ties = _tied_pairs(np.sort(x)[np.newaxis, :])[0]
+    y_ties = _tied_pairs(np.sort(y[:1], axis=1))[0]
+    con_minus_dis = (n_pairs - x_ties - y_ties + _tied_pairs(keys) -
+                     2 * _count_inversions(keys % n))
+    return con_minus_dis / np.sqrt(n_pairs - x_ties) / np.sqrt(n_pairs - y_ties)
+
+
+def _correlation_prepared(data1, data2, metric):
+    """ Correlation between each row of data1 (n_rows, n) and data2 (n,),
+        or each column of data2 (n, n_targets), both transformed by
+        _correlation_ranks.
+    """
+    if metric == 'kendall':
+        if data2.ndim == 2:
+            return np.column_stack([_kendall_tau(x, data1) for x in data2.T])
+        return _kendall_tau(data2, data1)
+    return np.dot(data1, data2)
+
+
+def _permute_correlation(data1, data2, metric, n_permute, random_state=None):
+    """ Null distribution of the correlation with data1 permuted, using a
+        block of permutation indices to gather data1 prepared by
+        _correlation_ranks.
+    """
+    random_state = check_random_state(random_state)
+    perm_ix = np.argsort(random_state.rand(n_permute, len(data1)), axis=1)
+    return _correlation_prepared(data1[perm_ix], data2, metric)
 
 
 def _calc_pvalue(all_p, stat, tail):
     """Calculates p value based on distribution of correlations
     This function is called by the permutation functions
-        all_p: list of correlation values from permutation
+        all_p: list of correlation values from permutation; if 2D, one
+               column per test
         stat: actual value being tested, i.e., stats['correlation'] or stats['mean']
         tail: (int) either 2 or 1 for two-tailed p-value or one-tailed
     """
+    all_p = np.asarray(all_p)
+    stat = np.asarray(stat)
     if tail == 2:
-        p = np.mean(np.abs(all_p) >= np.abs(stat))
+        p = np.mean(np.abs(all_p) >= np.abs(stat), axis=0)
     elif tail == 1:
-        if stat >= 0:
-            p = np.mean(all_p >= stat)
-        else:
-            p = np.mean(all_p <= stat)
+        p = np.where(stat >= 0, np.mean(all_p >= stat, axis=0),
+                     np.mean(all_p <= stat, axis=0))[()]
     else:
         raise ValueError('tail must be either 1 or 2')
     return p
 
 
+def _permute_blocks(func, n_permute, block_size, n_jobs=-1,
+                    random_state=None, **kwargs):
+    """ Compute a permutation null distribution in blocks of permutations.
+        Each block gets its own seed drawn from random_state, so the result
+        does not depend on n_jobs. Blocks are run on threads as the work is
+        done by numpy.
+
+        Args:
+            func: (callable) func(n_permute=, random_state=, **kwargs)
+                  returning the null values for a block of permutations, or
+                  a tuple of arrays that are each stacked over blocks
+            n_permute: (int) number of permutations
+            block_size: (int) number of permutations per block
+            n_jobs: (int) The number of CPUs to use to do the computation.
+                    -1 means all CPUs.
+            random_state: random_state instance for permutation
+
+        Returns:
+            all_p: (np.array) null distribution stacked over blocks
+    """
+    random_state = check_random_state(random_state)
+    block_size = int(max(1, min(block_size, n_permute)))
+    sizes = [block_size] * (n_permute // block_size)
+    if n_permute % block_size or not sizes:
+        sizes.append(n_permute % block_size)
+    seeds = random_state.randint(MAX_INT, size=len(sizes))
+    if n_jobs == 1 or len(sizes) == 1:
+        all_p = [func(n_permute=n, random_state=seed, **kwargs)
+                 for n, seed in zip(sizes, seeds)]
+    else:
+        all_p = Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(func)(n_permute=n, random_state=seed, **kwargs)
+            for n, seed in zip(sizes, seeds))
+    if isinstance(all_p[0], tuple):
+        return tuple(np.concatenate(x) for x in zip(*all_p))
+    return np.concatenate(all_p)
+
+
+def _block_size(n, max_elements=2**22):
+    """ Number of permutations per block so that a block of n-sized
+        permutations holds at most max_elements values.
+    """
+    return max(1, max_elements // max(n, 1))
+
+
 def one_sample_permutation(data, n_permute=5000, tail=2, n_jobs=-1, random_state=None):
-    ''' One sample permutation test using randomization.
+    ''' One sample permutation test using randomization. The null
+        distribution is computed in blocks as a matrix of random signs times
+        the data, so many permutations and many tests run at once.
 
         Args:
-            data: (pd.DataFrame, pd.Series, np.array) data to permute
+            data: (pd.DataFrame, pd.Series, np.array) data to permute; if 2D,
+                  each column is tested separately with the same sign flips
             n_permute: (int) number of permutations
             tail: (int) either 1 for one-tail or 2 for two-tailed test (default: 2)
             n_jobs: (int) The number of CPUs to use to do the computation.
                     -1 means all CPUs.
 
         Returns:
-            stats: (dict) dictionary of permutation results ['mean','p']
+            stats: (dict) dictionary of permutation results ['mean','p'];
+                   arrays with one value per column for 2D data
 
     '''
 
-    random_state = check_random_state(random_state)
-    seeds = random_state.randint(MAX_INT, size=n_permute)
-
-    data = np.array(data)
+    data = np.array(data, dtype=float)
+    if data.ndim > 2:
+        raise ValueError('data must be 1D or 2D.')
     stats = dict()
-    stats['mean'] = np.mean(data)
+    stats['mean'] = np.mean(data, axis=0)
 
-    all_p = Parallel(n_jobs=n_jobs)(delayed(_permute_sign)(data,
-                                                           random_state=seeds[i]) for i in range(n_permute))
+    all_p = _permute_blocks(_permute_sign, n_permute,
+                            _block_size(sum(data.shape)), n_jobs=n_jobs,
+                            random_state=random_state, data=data)
     stats['p'] = _calc_pvalue(all_p, stats['mean'], tail)
     return stats
 
 
+def _edge_components(supra, source, target, n_nodes):
+    """ Connected components formed by the suprathreshold edges of a stack
+        of graphs. The graphs are laid out as one block diagonal graph, so
+        the components of all of them are labeled in a single pass.
+
+        Args:
+            supra: (np.array) graphs by edges boolean array of
+                   suprathreshold edges
+            source: (np.array) first node of each edge
+            target: (np.array) second node of each edge
+            n_nodes: (int) number of nodes per graph
+
+        Returns:
+            labels: (np.array) graphs by edges component label of each
+                    suprathreshold edge, -1 elsewhere
+            size: (np.array) number of edges in each component
+            graph: (np.array) graph of each component
+    """
+    supra = np.atleast_2d(supra)
+    graph, edge = np.nonzero(supra)
+    offset = graph * n_nodes
+    n_total = len(supra) * n_nodes
+    n_components, node_labels = connected_components(
+        csr_matrix((np.ones(len(edge), dtype=bool),
+                    (offset + source[edge], offset + target[edge])),
+                   shape=(n_total, n_total)), directed=False)
+    labels = np.full(supra.shape, -1)
+    labels[graph, edge] = node_labels[offset + source[edge]]
+    component_graph = np.zeros(n_components, dtype=int)
+    component_graph[node_labels] = np.arange(n_total) // n_nodes
+    return (labels, np.bincount(labels[graph, edge], minlength=n_components),
+            component_graph)
+
+
+def _max_component_size(supra, source, target, n_nodes):
+    """ Number of edges in the largest suprathreshold component of each
+        graph in a stack."""
+    _, size, graph = _edge_components(supra, source, target, n_nodes)
+    out = np.zeros(len(np.atleast_2d(supra)), dtype=int)
+    np.maximum.at(out, graph, size)
+    return out
+
+
+def _suprathreshold(stat, threshold, tail):
+    """ Edges beyond the primary threshold; both signs if tail is 2."""
+    if tail == 2:
+        return np.abs(stat) > threshold
+    return stat > threshold if threshold >= 0 else stat < threshold
+
+
+def _sign_flip_t(mean, sumsq, n):
+    """ One sample t statistic from the mean and the sum of squares, which
+        does not change under sign flips."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.square(mean)
+        np.subtract(sumsq / n, t, out=t)
+        t /= n - 1
+        np.sqrt(t, out=t)
+        return np.divide(mean, t, out=t)
+
+
+def _permute_sign_edges(data, stat, tail, n_permute, fwe=False,
+                        nbs_threshold=None, source=None, target=None,
+                        n_nodes=None, random_state=None):
+    """ Block of sign flip permutations of a one sample test over edges.
+        The null is reduced within the block, so only per-edge exceedance
+        counts and per-permutation maxima are kept.
+
+        Returns:
+            counts: (np.array) 1 by edges number of null means as or more
+                    extreme than stat
+            max_t: (np.array) largest t statistic of each permutation
+            min_t: (np.array) smallest t statistic of each permutation
+            max_size: (np.array) largest suprathreshold component of each
+                      permutation
+            The last three are zeros unless fwe or nbs_threshold are set.
+    """
+    null = _permute_sign(data, n_permute, random_state=random_state)
+    counts = n_permute * np.atleast_1d(_calc_pvalue(null, stat, tail))
+    max_t, min_t = np.zeros(n_permute), np.zeros(n_permute)
+    max_size = np.zeros(n_permute, dtype=int)
+    if fwe or nbs_threshold is not None:
+        t = _sign_flip_t(null, (data ** 2).sum(axis=0), data.shape[0])
+        if fwe:
+            max_t, min_t = np.nanmax(t, axis=1), np.nanmin(t, axis=1)
+        if nbs_threshold is not None:
+            max_size = _max_component_size(
+                _suprathreshold(t, nbs_threshold, tail), source, target,
+                n_nodes)
+    return counts[np.newaxis], max_t, min_t, max_size
+
+
+def _nbs_components(supra, null_size, source, target, n_nodes):
+    """ Suprathreshold components of the observed graph with family-wise
+        error corrected p-values from the null distribution of the largest
+        component size.
+
+        Returns:
+            labels: (np.array) component of each edge numbered from 1 by
+                    decreasing size, 0 for edges outside any component
+            size: (np.array) number of edges in each component
+            p: (np.array) corrected p-value of each component
+    """
+    labels, size, _ = _edge_components(supra, source, target, n_nodes)
+    labels = labels[0]
+    present, index = np.unique(labels[labels >= 0], return_inverse=True)
+    size = size[present]
+    order = np.argsort(-size, kind='stable')
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(1, len(order) + 1)
+    out = np.zeros(len(labels), dtype=int)
+    out[labels >= 0] = rank[index]
+    size = size[order]
+    p = np.mean(null_size[:, np.newaxis] >= size, axis=0)
+    return out, size, p
+
+
+def _design_basis(design, contrast=None):
+    """ Orthonormal basis of a design matrix and the contrast weights on it,
+        so the contrast estimate is weights times the projection of the data
+        on the basis.
+
+        Args:
+            design: (np.array) observations by regressors design matrix
+            contrast: (np.array) weight of each regressor; defaults to the
+                      last regressor
+
+        Returns:
+            basis: (np.array) observations by regressors orthonormal basis
+            weights: (np.array) contrast weights on the basis
+    """
+    design = np.array(design, dtype=float)
+    if design.ndim == 1:
+        design = design[:, np.newaxis]
+    if np.linalg.matrix_rank(design) < design.shape[1]:
+        raise ValueError('Design matrix is rank deficient.')
+    if contrast is None:
+        contrast = np.zeros(design.shape[1])
+        contrast[-1] = 1
+    contrast = np.asarray(contrast, dtype=float)
+    if contrast.shape != (design.shape[1],):
+        raise ValueError('Contrast must have one weight per regressor.')
+    basis, r = np.linalg.qr(design)
+    return basis, np.linalg.solve(r.T, contrast)
+
+
+def _design_t(proj, weights, sumsq, df):
+    """ t statistic of a contrast from the projections (..., regressors,
+        tests) of the data on an orthonormal basis of the design.
+    """
+    # Regressors are accumulated one at a time to avoid large temporaries
+    effect = weights[0] * proj[..., 0, :]
+    rss = np.square(proj[..., 0, :])
+    for i in range(1, len(weights)):
+        effect += weights[i] * proj[..., i, :]
+        rss += np.square(proj[..., i, :])
+    np.subtract(sumsq, rss, out=rss)
+    rss *= np.dot(weights, weights) / df
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.sqrt(rss, out=rss)
+        return np.divide(effect, rss, out=rss)
+
+
+def _permute_design_edges(data, sumsq, basis, weights, nbs_threshold, tail,
+                          source, target, n_nodes, n_permute,
+                          random_state=None):
+    """ Block of permutations of the rows of the design for the network
+        based statistic. The projections of all permuted designs are
+        computed as one matrix product.
+
+        Returns:
+            max_size: (np.array) largest suprathreshold component of each
+                      permutation
+    """
+    random_state = check_random_state(random_state)
+    n, k = basis.shape
+    perm_ix = np.argsort(random_state.rand(n_permute, n), axis=1)
+    proj = np.dot(basis[perm_ix].transpose(0, 2, 1).reshape(-1, n), data)
+    t = _design_t(proj.reshape(n_permute, k, -1), weights, sumsq, n - k)
+    return _max_component_size(_suprathreshold(t, nbs_threshold, tail),
+                               source, target, n_nodes)
+
+
+def _fwe_pvalue(stat, max_null, min_null, tail):
+    """ Family-wise error corrected p-values from the maximum (and
+        minimum) statistic of each permutation."""
+    if tail == 2:
+        return _calc_pvalue(np.maximum(np.abs(max_null), np.abs(min_null))[:, np.newaxis],
+                            stat, tail)
+    return np.where(stat >= 0,
+                    _calc_pvalue(max_null[:, np.newaxis], stat, tail),
+                    _calc_pvalue(min_null[:, np.newaxis], stat, tail))
+
+
 def two_sample_permutation(data1, data2, n_permute=5000,
-                           tail=2, n_jobs=-1, random_state=None):
-    ''' Independent sample permutation test.
+                           tail=2, n_jobs=-1, random_state=None, welch=False):
+    ''' Independent sample permutation test. Group labels are permuted in
+        blocks and the null distribution is computed with array reductions.
 
         Args:
-            data1: (pd.DataFrame, pd.Series, np.array) dataset 1 to permute
-            data2: (pd.DataFrame, pd.Series, np.array) dataset 2 to permute
+            data1: (pd.DataFrame, pd.Series, np.array) dataset 1 to permute;
+                   if 2D, each column is tested separately
+            data2: (pd.DataFrame, pd.Series, np.array) dataset 2 to permute;
+                   must have the same number of columns as data1
             n_permute: (int) number of permutations
             tail: (int) either 1 for one-tail or 2 for two-tailed test (default: 2)
             n_jobs: (int) The number of CPUs to use to do the computation.
                     -1 means all CPUs.
+            welch: (bool) test Welch's t rather than the mean difference
         Returns:
-            stats: (dict) dictionary of permutation results ['mean','p']
+            stats: (dict) dictionary of permutation results ['mean','p'] and
+                   ['t'] if welch=True; arrays with one value per column for
+                   2D data
 
     '''
 
-    random_state = check_random_state(random_state)
-    seeds = random_state.randint(MAX_INT, size=n_permute)
+    data1 = np.array(data1, dtype=float)
+    data2 = np.array(data2, dtype=float)
+    if data1.ndim > 2 or data1.shape[1:] != data2.shape[1:]:
+        raise ValueError('data1 and data2 must be 1D or 2D with the same '
+                         'number of columns.')
+    data = np.concatenate([data1, data2])
+    n1 = data1.shape[0]
 
     stats = dict()
-    stats['mean'] = np.mean(data1)-np.mean(data2)
-    data = pd.DataFrame(data={'Values': data1, 'Group': np.ones(len(data1))})
-    data = data.append(pd.DataFrame(data={
-                                        'Values': data2,
-                                        'Group': np.zeros(len(data2))}))
-    all_p = Parallel(n_jobs=n_jobs)(delayed(_permute_group)(data,
-                                                            random_state=seeds[i]) for i in range(n_permute))
-
-    stats['p'] = _calc_pvalue(all_p, stats['mean'], tail)
+    stats['mean'] = np.mean(data1, axis=0) - np.mean(data2, axis=0)
+    stat = stats['mean']
+    if welch:
+        stats['t'] = _group_stat(data1.sum(axis=0), (data1 ** 2).sum(axis=0),
+                                 n1, data.sum(axis=0), (data ** 2).sum(axis=0),
+                                 data2.shape[0], welch=True)
+        stat = stats['t']
+
+    all_p = _permute_blocks(_permute_group, n_permute,
+                            _block_size(sum(data.shape)), n_jobs=n_jobs,
+                            random_state=random_state,
+                            data=data - data.mean(axis=0), n1=n1, welch=welch)
+    stats['p'] = _calc_pvalue(all_p, stat, tail)
     return stats
 
 
 def correlation_permutation(data1, data2, n_permute=5000, metric='spearman',
                             tail=2, n_jobs=-1, random_state=None):
-    ''' Permute correlation.
+    ''' Permute correlation. The data are ranked and standardized once and
+        the null distribution is computed in blocks of permutations, so
+        results for a given random_state do not depend on n_jobs. Many
+        datasets can be tested against data2 with the same permutations.
 
         Args:
-        data1: (pd.DataFrame, pd.Series, np.array) dataset 1 to permute
+        data1: (pd.DataFrame, pd.Series, np.array, list) dataset 1 to
+               permute, or a list of datasets to test separately
         data2: (pd.DataFrame, pd.Series, np.array) dataset 2 to permute
             n_permute: (int) number of permutations
             metric: (str) type of association metric ['spearman','pearson',
@@ -569,37 +1082,54 @@ def correlation_permutation(data1, data2, n_permute=5000, metric='spearman',
                     -1 means all CPUs.
 
         Returns:
-            stats: (dict) dictionary of permutation results ['correlation','p']
+            stats: (dict) dictionary of permutation results ['correlation','p'];
+                   arrays with one value per dataset if data1 is a list
 
     '''
 
-    random_state = check_random_state(random_state)
-
+    data2 = _correlation_ranks(np.array(data2).ravel(), metric)
     stats = dict()
-    data1 = np.array(data1)
-    data2 = np.array(data2)
-
-    stats['correlation'] = correlation(data1, data2, metric=metric)[0]
-
-    all_p = Parallel(n_jobs=n_jobs)(delayed(correlation)(
-                    random_state.permutation(data1), data2, metric=metric)
-                    for i in range(n_permute))
-    all_p = [x[0] for x in all_p]
+    if isinstance(data1, list) and np.ndim(data1[0]) > 0:
+        data1 = _correlation_ranks(
+            np.column_stack([np.ravel(x) for x in data1]), metric)
+        if len(data1) != len(data2):
+            raise ValueError('Data must be the same length.')
+        stats['correlation'] = _correlation_prepared(data2[np.newaxis, :],
+                                                     data1, metric)[0]
+        # data2 is permuted instead, so every dataset shares its ranking and
+        # the same permutations
+        all_p = _permute_blocks(_permute_correlation, n_permute,
+                                _block_size(len(data2) + data1.shape[1]),
+                                n_jobs=n_jobs, random_state=random_state,
+                                data1=data2, data2=data1, metric=metric)
+    else:
+        data1 = _correlation_ranks(np.array(data1).ravel(), metric)
+        stats['correlation'] = _correlation_prepared(data1[np.newaxis, :],
+                                                     data2, metric)[0]
+        all_p = _permute_blocks(_permute_correlation, n_permute,
+                                _block_size(len(data1)), n_jobs=n_jobs,
+                                random_state=random_state, data1=data1,
+                                data2=data2, metric=metric)
 
     stats['p'] = _calc_pvalue(all_p, stats['correlation'], tail)
     return stats
 
 
 def matrix_permutation(data1, data2, n_permute=5000, metric='spearman',
-                       tail=2, random_state=None):
-    """ Permute 2-dimensional matrix correlation (mantel test).
+                       tail=2, n_jobs=-1, random_state=None):
+    """ Permute 2-dimensional matrix correlation (mantel test). Rows and
+        columns of data2 are permuted together and the upper triangles are
+        ranked or standardized once, so the null distribution is computed
+        in blocks of index gathers and a matrix product. Many target
+        matrices can be tested against data2 with the same permutations.
 
         Chen, G. et al. (2016). Untangling the relatedness among correlations,
         part I: nonparametric approaches to inter-subject correlation analysis
         at the group level. Neuroimage, 142, 248-259.
 
         Args:
-            data1: (pd.DataFrame, np.array) square matrix
+            data1: (pd.DataFrame, np.array, list) square matrix, or a list or
+                   3D array of square matrices to test separately
             data2: (pd.DataFrame, np.array) square matrix
             n_permute: (int) number of permutations
             metric: (str) type of association metric ['spearman','pearson',
@@ -610,22 +1140,46 @@ def matrix_permutation(data1, data2, n_permute=5000, metric='spearman',
                     -1 means all CPUs.
 
         Returns:
-            stats: (dict) dictionary of permutation results ['correlation','p']
+            stats: (dict) dictionary of permutation results ['correlation','p'];
+                   arrays with one value per matrix if data1 is a list
     """
-    random_state = check_random_state(random_state)
-    sq_data1 = check_square_numpy_matrix(data1)
-    sq_data2 = check_square_numpy_matrix(data2)
-    data1 = sq_data1[np.triu_indices(sq_data1.shape[0], k=1)]
-    data2 = sq_data2[np.triu_indices(sq_data2.shape[0], k=1)]
+    sq_data2 = check_square_numpy_matrix(data2).astype(float)
+    stacked = (isinstance(data1, list) or
+               (isinstance(data1, np.ndarray) and data1.ndim == 3))
+    if stacked:
+        sq_data1 = [check_square_numpy_matrix(x) for x in data1]
+    else:
+        sq_data1 = [check_square_numpy_matrix(data1)]
+    if any([x.shape != sq_data2.shape for x in sq_data1]):
+        raise ValueError('Matrices must be the same size.')
+    triu = np.triu_indices(sq_data2.shape[0], k=1)
+    data1 = _correlation_ranks(np.column_stack([x[triu] for x in sq_data1]),
+                               metric)
+
+    symmetric = np.allclose(sq_data2, sq_data2.T)
+    if symmetric:
+        data2 = _correlation_ranks(sq_data2[triu], metric)
+        sq_data2 = np.zeros(sq_data2.shape, dtype=data2.dtype)
+        sq_data2[triu] = data2
+        sq_data2 = sq_data2 + sq_data2.T
+    else:
+        data2 = _correlation_ranks(sq_data2[triu], metric)
 
     stats = dict()
+    if metric == 'kendall':
+        stats['correlation'] = _kendall_tau(data2, data1.T)
+    else:
+        stats['correlation'] = np.dot(data2, data1)
 
-    stats['correlation'] = correlation(data1, data2, metric=metric)[0]
-
-    all_p = Parallel(backend='threading')(delayed(_permute_func)(
-                    pd.DataFrame(sq_data1), data2, metric=metric)
-                    for i in range(n_permute))
+    all_p = _permute_blocks(_permute_matrix, n_permute,
+                            _block_size(len(data2) + data1.shape[1]),
+                            n_jobs=n_jobs, random_state=random_state,
+                            data1=data1, data2=sq_data2, metric=metric,
+                            symmetric=symmetric)
     stats['p'] = _calc_pvalue(all_p, stats['correlation'], tail)
+    if not stacked:
+        stats['correlation'] = stats['correlation'][0]
+        stats['p'] = stats['p'][0]
     return stats
 
 
@@ -633,7 +1187,8 @@ def jackknife_permutation(data1, data2, metric='spearman',
                           p_value='permutation', n_jobs=-1, n_permute=5000,
                           tail=2, random_state=None):
     ''' This function uses a randomization test on a jackknife of absolute
-        distance/similarity of each subject
+        distance/similarity of each subject. The leave-one-out correlations
+        of all subjects' rows are computed at once.
 
         Args:
             data1: (Adjacency, pd.DataFrame, np.array) square matrix
@@ -656,13 +1211,24 @@ def jackknife_permutation(data1, data2, metric='spearman',
     data1 = check_square_numpy_matrix(data1)
     data2 = check_square_numpy_matrix(data2)
 
+    if data1.shape != data2.shape:
+        raise ValueError('Matrices must be the same size.')
+
+    # Leave-one-out rows with the diagonal removed, prepared once per row so
+    # all correlations reduce to one row-wise dot product
+    off_diagonal = ~np.eye(data1.shape[0], dtype=bool)
+    rows1 = _correlation_ranks(
+        data1[off_diagonal].reshape(data1.shape[0], -1).T, metric).T
+    rows2 = _correlation_ranks(
+        data2[off_diagonal].reshape(data2.shape[0], -1).T, metric).T
     stats = {}
-    stats['all_r'] = []
-    for s in range(data1.shape[0]):
-        stats['all_r'].append(correlation(np.delete(data1[s, ], s),
-                                          np.delete(data2[s, ], s),
-                                          metric=metric)[0])
-    stats['correlation'] = np.mean(stats['all_r'])
+    if metric == 'kendall':
+        all_r = np.array([_kendall_tau(x, y[np.newaxis, :])[0]
+                          for x, y in zip(rows1, rows2)])
+    else:
+        all_r = np.einsum('ij,ij->i', rows1, rows2)
+    stats['all_r'] = list(all_r)
+    stats['correlation'] = np.mean(all_r)
 
     if p_value == 'permutation':
         stats_permute = one_sample_permutation(stats['all_r'],
@@ -728,7 +1294,36 @@ def make_cosine_basis(nsamples, sampling_freq, filter_length, unit_scale=True, d
     return C
 
 
-def transform_pairwise(X, y):
+def _pairwise_index(y):
+    '''Helper function for transform_pairwise. Returns the row indices of
+        each valid pair (i, j), the sign needed to balance the classes, and
+        the group label of each pair.'''
+    i, j = np.triu_indices(y.shape[0], k=1)
+    # k indexes every combination so that classes alternate as in the
+    # original enumeration over itertools.combinations
+    k = np.arange(len(i))
+    valid = (y[i, 0] != y[j, 0]) & (y[i, 1] == y[j, 1])
+    i, j, k = i[valid], j[valid], k[valid]
+    y_new = np.where(k % 2, -1, 1).astype(y.dtype)
+    flip = np.sign(y[i, 0] - y[j, 0]) * y_new
+    return i, j, flip, y_new, y[i, 1]
+
+
+def _transform_pairwise_batches(X, y_ndim, i, j, flip, y_new, y_group,
+                                batch_size):
+    '''Generator yielding transform_pairwise output in blocks of pairs.'''
+    for start in range(0, len(i), batch_size):
+        b = slice(start, start + batch_size)
+        X_block = X[i[b]] - X[j[b]]
+        X_block *= flip[b].astype(X_block.dtype).reshape(
+            (-1,) + (1,) * (X_block.ndim - 1))
+        if y_ndim == 1:
+            yield X_block, y_new[b]
+        else:
+            yield X_block, np.vstack((y_new[b], y_group[b])).T
+
+
+def transform_pairwise(X, y, batch_size=None):
     '''Transforms data into pairs with balanced labels for ranking
     Transforms a n-class ranking problem into a two-class classification
     problem. Subclasses implementing particular strategies for choosing
@@ -748,6 +1343,9 @@ def transform_pairwise(X, y):
             Target labels. If it's a 2D array, the second column represents
             the grouping of samples, i.e., samples with different groups will
             not be considered.
+        batch_size: (int) if provided, return a generator yielding
+            (X_trans, y_trans) blocks of at most batch_size pairs instead of
+            building all pairs at once; default None
 
     Returns:
         X_trans: (np.array), shape (k, n_feaures)
@@ -760,26 +1358,26 @@ def transform_pairwise(X, y):
             the second dimension.
     '''
 
-    X_new, y_new, y_group = [], [], []
+    X = np.asarray(X)
+    y = np.asarray(y)
     y_ndim = y.ndim
     if y.ndim == 1:
         y = np.c_[y, np.ones(y.shape[0])]
-    comb = itertools.combinations(range(X.shape[0]), 2)
-    for k, (i, j) in enumerate(comb):
-        if y[i, 0] == y[j, 0] or y[i, 1] != y[j, 1]:
-            # skip if same target or different group
-            continue
-        X_new.append(X[i] - X[j])
-        y_new.append(np.sign(y[i, 0] - y[j, 0]))
-        y_group.append(y[i, 1])
-        # output balanced classes
-        if y_new[-1] != (-1) ** k:
-            y_new[-1] = - y_new[-1]
-            X_new[-1] = - X_new[-1]
+    i, j, flip, y_new, y_group = _pairwise_index(y)
+
+    if batch_size is not None:
+        if batch_size < 1:
+            raise ValueError('batch_size must be a positive integer.')
+        return _transform_pairwise_batches(X, y_ndim, i, j, flip, y_new,
+                                           y_group, int(batch_size))
+
+    X_new = X[i] - X[j]
+    # flip is +/-1, so casting keeps integer X integer as before
+    X_new *= flip.astype(X_new.dtype).reshape((-1,) + (1,) * (X_new.ndim - 1))
     if y_ndim == 1:
-        return np.asarray(X_new), np.asarray(y_new).ravel()
+        return X_new, y_new
     elif y_ndim == 2:
-        return np.asarray(X_new), np.vstack((np.asarray(y_new), np.asarray(y_group))).T
+        return X_new, np.vstack((y_new, y_group)).T
 
 
 def _robust_estimator(vals, X, robust_estimator='hc0', nlags=1):
@@ -1008,6 +1606,427 @@ def regress(X, Y, mode='ols', **kwargs):
     return b.squeeze(), t.squeeze(), p.squeeze(), df.squeeze(), res.squeeze()
 
 
+def _subject_stack(data):
+    ''' Stack subjects' samples by features data into a 3D subjects by
+        samples by features array, along with a function converting a
+        vector of feature values to the type of the subject data.
+
+        Args:
+            data: (list, np.array) list of Brain_Data instances or samples
+                  by features arrays (one per subject), or a 3D subjects by
+                  samples by features array
+
+        Returns:
+            stack: (np.array) subjects by samples by features array
+            convert: (function) converts a feature vector to Brain_Data
+                     when data is a list of Brain_Data
+
+    '''
+    if isinstance(data, np.ndarray):
+        if data.ndim != 3:
+            raise ValueError('Array data must be 3D (subjects x samples x '
+                             'features).')
+        stack, convert = np.asarray(data, dtype=float), lambda x: x
+    elif isinstance(data, (list, tuple)):
+        values = [_timeseries_array(x) for x in data]
+        if len(set(x.shape for x, _ in values)) > 1:
+            raise ValueError('All subjects must have the same number of '
+                             'samples and features.')
+        stack = np.stack([x for x, _ in values]).astype(float)
+        convert = values[0][1] if hasattr(data[0], 'nifti_masker') else (lambda x: x)
+    else:
+        raise ValueError('Make sure data is a list of subjects or a 3D array.')
+    if stack.shape[0] < 2:
+        raise ValueError('At least 2 subjects are required.')
+    return stack, convert
+
+
+def _zscore_samples(data):
+    ''' Z-score an array over its last (samples) axis. Constant features
+        are set to 0 so their correlations are 0. '''
+    data = data - data.mean(axis=-1, keepdims=True)
+    sd = np.sqrt((data ** 2).mean(axis=-1, keepdims=True))
+    return np.divide(data, sd, out=data, where=sd > 0)
+
+
+def _isc_weights(n_subjects, inference, n_permute, random_state=None):
+    ''' Subject weights (n_permute x n_subjects) for the null distribution
+        of the ISC: bootstrap resampling counts or random signs. '''
+    random_state = check_random_state(random_state)
+    if inference == 'bootstrap':
+        idx = random_state.randint(n_subjects, size=(n_permute, n_subjects))
+        idx += n_subjects * np.arange(n_permute)[:, np.newaxis]
+        weights = np.bincount(idx.ravel(), minlength=n_permute * n_subjects)
+        return weights.reshape(n_permute, n_subjects).astype(float)
+    elif inference == 'permutation':
+        signs = random_state.randint(2, size=(n_permute, n_subjects))
+        return (2 * signs - 1).astype(float)
+    raise ValueError("inference must be None, 'bootstrap' or 'permutation'")
+
+
+def isc(data, method='pairwise', inference=None, n_permute=5000, tail=2,
+        random_state=None):
+    ''' Compute the intersubject correlation (ISC) of every feature (e.g.,
+        voxel or ROI) across subjects.
+
+        The time series of each subject are z-scored and correlated with
+        batched matrix products over chunks of features. The 'pairwise' ISC
+        is the mean correlation over all pairs of subjects and the
+        'leave_one_out' ISC the mean correlation of each subject with the
+        average of the others' raw time series.
+
+        Inference is done at the subject level with the same subject weights
+        for every feature. 'bootstrap' resamples subjects with replacement
+        (excluding pairs of a subject with itself) and tests the centered
+        bootstrap distribution (Chen et al., 2016). 'permutation' randomly
+        flips the sign of each subject's correlations.
+
+        Args:
+            data: (list, np.array) list of Brain_Data instances or samples
+                  by features arrays (one per subject), or a 3D subjects by
+                  samples by features array
+            method: (str) 'pairwise' or 'leave_one_out'
+            inference: (str) None, 'bootstrap' or 'permutation'
+            n_permute: (int) number of bootstrap samples or permutations
+            tail: (int) either 1 for one-tail or 2 for two-tailed test
+                  (default: 2)
+            random_state: (int, None, or np.random.RandomState) Initial
+                  random seed (default: None)
+
+        Returns:
+            stats: (dict) dictionary of results ['isc', 'p'] with one value
+                   per feature; Brain_Data for Brain_Data inputs. For the
+                   leave-one-out method, 'subjects' holds the subjects by
+                   features correlations.
+
+    '''
+    if method not in ['pairwise', 'leave_one_out']:
+        raise ValueError("method must be 'pairwise' or 'leave_one_out'")
+    stack, convert = _subject_stack(data)
+    n_subjects, n_samples, n_features = stack.shape
+    if inference is not None:
+        weights = _isc_weights(n_subjects, inference, n_permute,
+                               random_state=random_state)
+        n_block = _block_size(n_subjects ** 2)
+        p = np.zeros(n_features)
+
+    r = np.zeros(n_features)
+    subjects = np.zeros((n_subjects, n_features))
+    chunk = max(1, 2**22 // (n_subjects * max(n_samples, n_subjects)))
+    for start in range(0, n_features, chunk):
+        cols = slice(start, start + chunk)
+        # Features by subjects by samples
+        x = np.ascontiguousarray(stack[:, :, cols].transpose(2, 0, 1))
+        if method == 'leave_one_out':
+            # Sum of the others, which correlates as their average
+            others = _zscore_samples(x.sum(axis=1, keepdims=True) - x)
+        z = _zscore_samples(x)
+        if method == 'pairwise' and inference is None:
+            # Sum over pairs from the squared norm of the sum over subjects
+            pairs = (z.sum(axis=1) ** 2).sum(axis=1) - (z ** 2).sum(axis=(1, 2))
+            r[cols] = pairs / (n_samples * n_subjects * (n_subjects - 1))
+        elif method == 'pairwise':
+            # Subjects by subjects correlations of each feature
+            corr = np.matmul(z, z.transpose(0, 2, 1)) / n_samples
+            corr[:, np.arange(n_subjects), np.arange(n_subjects)] = 0
+            corr = corr.reshape(corr.shape[0], -1)
+            r[cols] = corr.sum(axis=1) / (n_subjects * (n_subjects - 1))
+        else:
+            subjects[:, cols] = (z * others).mean(axis=2).T
+            r[cols] = subjects[:, cols].mean(axis=0)
+
+        if inference is not None:
+            for b in range(0, n_permute, n_block):
+                w = weights[b:b + n_block]
+                if method == 'pairwise':
+                    # Mean over pairs of the weighted correlations, with pairs
+                    # of a (resampled) subject with itself left out
+                    outer = (w[:, :, np.newaxis] * w[:, np.newaxis, :]).reshape(len(w), -1)
+                    n_pairs = n_subjects ** 2 - (w ** 2).sum(axis=1)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        null = np.dot(outer, corr.T) / n_pairs[:, np.newaxis]
+                else:
+                    null = np.dot(w, subjects[:, cols]) / n_subjects
+                if inference == 'bootstrap':
+                    null = null - r[cols]
+                p[cols] += _calc_pvalue(null, r[cols], tail) * len(w) / n_permute
+
+    stats = {'isc': convert(r)}
+    if method == 'leave_one_out':
+        stats['subjects'] = convert(subjects)
+    if inference is not None:
+        stats['p'] = convert(p)
+    return stats
+
+
+def _roi_timeseries(data, mask):
+    ''' Extract the mean time series of each ROI of an atlas for each
+        subject, with one sparse matrix product per subject.
+
+        Args:
+            data: (list) list of Brain_Data instances (one per subject)
+            mask: (Brain_Data, nifti) atlas with an integer label per ROI
+
+        Returns:
+            out: (list) samples by ROIs array for each subject, with ROIs in
+                 increasing order of label
+
+    '''
+    mask = check_brain_data(mask)
+    labels = np.round(mask.data).astype(int).ravel()
+    voxels = np.flatnonzero(labels)
+    rois, columns = np.unique(labels[voxels], return_inverse=True)
+    weights = csr_matrix((1 / np.bincount(columns)[columns], (voxels, columns)),
+                         shape=(len(labels), len(rois)))
+    if any(x.data.shape[-1] != len(labels) for x in data):
+        raise ValueError('Make sure the mask has the same number of voxels '
+                         'as the data.')
+    return [weights.T.dot(np.atleast_2d(x.data).T).T for x in data]
+
+
+def seed_correlation(data, seeds, fisher_z=False, chunk_size=10000):
+    ''' Correlate seed time series with every voxel for each subject. See
+        Brain_Data.seed_correlation.
+
+        Args:
+            data: (list) list of Brain_Data instances (one per subject)
+            seeds: (list, nifti, Brain_Data) list of images by seeds arrays
+                   (one per subject), or a mask with a different integer for
+                   each seed ROI, whose mean time series are extracted from
+                   every subject with one shared averaging matrix
+            fisher_z: (bool) return Fisher z transformed correlations
+            chunk_size: (int) number of voxels per matrix product;
+                        default 10000
+
+        Returns:
+            out: (list) Brain_Data of seed correlation maps for each subject
+
+    '''
+    if not isinstance(data, list):
+        raise ValueError('Make sure data is a list of Brain_Data instances.')
+    if not isinstance(seeds, list):
+        seeds = _roi_timeseries(data, seeds)
+    if len(seeds) != len(data):
+        raise ValueError('Make sure there are seeds for each subject.')
+    return [x.seed_correlation(s, fisher_z=fisher_z, chunk_size=chunk_size)
+            for x, s in zip(data, seeds)]
+
+
+def _covariance_stack(data, estimator='empirical'):
+    ''' Covariance matrices of a list of samples by features arrays, with
+        Ledoit-Wolf or OAS shrinkage computed for all of them at once.
+        Matches sklearn.covariance.ledoit_wolf and oas.
+
+        Args:
+            data: (list) samples by features arrays with the same number of
+                  features
+            estimator: (str) 'empirical', 'ledoit_wolf' or 'oas'
+
+        Returns:
+            cov: (np.array) one features by features covariance per array
+            shrinkage: (np.array) shrinkage of each covariance
+
+    '''
+    if estimator not in ['empirical', 'ledoit_wolf', 'oas']:
+        raise ValueError("estimator must be 'empirical', 'ledoit_wolf' or "
+                         "'oas'")
+    cov, beta = [], []
+    for x in data:
+        x = x - x.mean(axis=0)
+        cov.append(np.dot(x.T, x) / len(x))
+        # Sum of the coefficients of <X2.T, X2>
+        beta.append(((x ** 2).sum(axis=1) ** 2).sum())
+    cov = np.stack(cov)
+    n_samples = np.array([len(x) for x in data], dtype=float)
+    n_features = cov.shape[1]
+    if estimator == 'empirical':
+        return cov, np.zeros(len(cov))
+
+    trace = np.trace(cov, axis1=1, axis2=2)
+    mu = trace / n_features
+    squares = (cov ** 2).sum(axis=(1, 2))
+    if estimator == 'ledoit_wolf':
+        beta = (np.array(beta) / n_samples - squares) / (n_features * n_samples)
+        delta = (squares - 2 * mu * trace + n_features * mu ** 2) / n_features
+        beta = np.minimum(beta, delta)
+        shrinkage = np.divide(beta, delta, out=np.zeros(len(cov)), where=beta != 0)
+    else:
+        alpha = squares / n_features ** 2
+        den = (n_samples + 1) * (alpha - mu ** 2 / n_features)
+        shrinkage = np.minimum(np.divide(alpha + mu ** 2, den, out=np.ones(len(cov)),
+                                         where=den != 0), 1)
+    cov *= (1 - shrinkage)[:, np.newaxis, np.newaxis]
+    cov[:, np.arange(n_features), np.arange(n_features)] += (shrinkage * mu)[:, np.newaxis]
+    return cov, shrinkage
+
+
+def isfc(data, mask=None):
+    ''' Compute the leave-one-out intersubject functional correlation (ISFC)
+        of each subject (Simony et al., 2016): the correlation of each
+        ROI's time series with every ROI of the average of the other
+        subjects, symmetrized. All subjects are correlated in a single
+        batched matrix product.
+
+        Args:
+            data: (list, np.array) list of Brain_Data instances or samples
+                  by features arrays (one per subject), or a 3D subjects by
+                  samples by features array
+            mask: (Brain_Data, nifti) atlas with an integer label per ROI;
+                  ROI time series are extracted once from each Brain_Data.
+                  If None, each feature of data is used as a ROI.
+
+        Returns:
+            isfc: (Adjacency) one similarity matrix of ROIs by ROIs per
+                  subject
+
+    '''
+    from nltools.data import Adjacency
+
+    if mask is not None:
+        if not isinstance(data, list) or len(data) < 2:
+            raise ValueError('Make sure data is a list of at least 2 '
+                             'Brain_Data instances.')
+        stack = np.stack(_roi_timeseries(data, mask))
+    else:
+        stack, _ = _subject_stack(data)
+    n_samples, n_rois = stack.shape[1:]
+
+    # Subjects by ROIs by samples
+    x = np.ascontiguousarray(stack.transpose(0, 2, 1))
+    # Sum of the others, which correlates as their average
+    others = _zscore_samples(x.sum(axis=0) - x)
+    z = _zscore_samples(x)
+    corr = np.matmul(z, others.transpose(0, 2, 1)) / n_samples
+    i, j = np.triu_indices(n_rois, k=1)
+    return Adjacency((corr[:, i, j] + corr[:, j, i]) / 2,
+                     matrix_type='similarity_flat')
+
+
+def _taper_components(taper, window, tau=None):
+    ''' Write the weights w_k (k = 0, ..., window - 1) of a window taper as
+        the real part of a sum of geometric series, sum(a * rate ** k), so
+        weighted sums can be slid incrementally. Returns (a, rate) pairs.
+    '''
+    if taper == 'rectangular':
+        return [(1., 1.)]
+    elif taper in ['hann', 'hamming']:
+        a0 = .5 if taper == 'hann' else .54
+        return [(a0, 1.), (a0 - 1, np.exp(2j * np.pi / (window - 1)))]
+    elif taper == 'exponential':
+        # w_k = exp((k - window + 1) / tau) up to a constant (Pozzi et al., 2012)
+        tau = window / 3 if tau is None else tau
+        if tau <= 0:
+            raise ValueError('tau must be positive.')
+        return [(1., np.exp(1 / tau))]
+    raise ValueError("taper must be 'rectangular', 'hann', 'hamming' or "
+                     "'exponential'")
+
+
+def _accumulate_window(sums, components, rows, offsets, signs):
+    ''' Add signed, tapered sums of the rows of a window to the running
+        sums of each taper component: the weights, the weighted rows and,
+        accumulated in place with BLAS, the real and imaginary parts of the
+        weighted outer products. The weights rate ** offset are relative to
+        the newest sample added before the sums are next recomputed.
+    '''
+    gemm = get_blas_funcs('gemm', (rows,))
+    for (_, rate), total in zip(components, sums):
+        weights = signs * rate ** offsets
+        total[0] += weights.sum()
+        total[1] += np.dot(weights, rows)
+        parts = [weights.real, weights.imag] if np.iscomplexobj(weights) else [weights]
+        for outer, part in zip(total[2], parts):
+            gemm(1.0, rows.T * part, rows, beta=1.0, c=outer.T, overwrite_c=True)
+
+
+def sliding_window_correlation(data, window, step=1, taper='rectangular',
+                               tau=None):
+    ''' Compute the correlation between every pair of features (e.g., ROI
+        time series) in sliding windows. The weighted sums of each window are
+        updated incrementally from the previous window, so each step costs
+        O(step * n_features ** 2) regardless of the window length. Sums are
+        recomputed from scratch once per window length to bound round-off,
+        or more often if needed to keep exponential taper weights finite.
+
+        Args:
+            data: (pd.DataFrame, np.array, Brain_Data) samples by features
+                  time series
+            window: (int) number of samples in each window
+            step: (int) number of samples between the starts of windows
+            taper: (str) weighting of samples within each window;
+                   'rectangular' (default), 'hann', 'hamming' or
+                   'exponential'
+            tau: (float) decay of the exponential taper in samples;
+                 default window / 3
+
+        Returns:
+            out: (Adjacency) one similarity matrix per window
+
+    '''
+    from nltools.data import Adjacency
+
+    data, _ = _timeseries_array(data)
+    data = np.ascontiguousarray(data - data.mean(axis=0), dtype=float)
+    n_samples, n_features = data.shape
+    if not 2 <= window <= n_samples:
+        raise ValueError('window must be between 2 and the number of samples.')
+    if step < 1:
+        raise ValueError('step must be a positive integer.')
+    components = _taper_components(taper, window, tau=tau)
+    axpy, ger = get_blas_funcs(('axpy', 'ger'), (data,))
+
+    n_windows = (n_samples - window) // step + 1
+    refresh = max(1, window // step)
+    # Weights decay from the newest sample of each recompute period, so cap
+    # the period to keep the weights of every window far from under/overflow
+    decay = max(abs(np.log(abs(rate))) for _, rate in components)
+    if decay > 0:
+        refresh = max(1, min(refresh, int(300 / decay) // step))
+    triu = np.triu(np.ones((n_features, n_features), dtype=bool), k=1)
+    cov = np.empty((n_features, n_features))
+    out = np.empty((n_windows, triu.sum()))
+    for w in range(n_windows):
+        start = w * step
+        if w % refresh == 0:
+            # Newest sample added before the next recompute
+            newest = min(start + refresh * step, n_windows * step) - step + window - 1
+            sums = [[0, np.zeros(n_features, dtype=np.result_type(rate)),
+                     [np.zeros((n_features, n_features))
+                      for _ in range(1 + np.iscomplexobj(rate))]]
+                    for _, rate in components]
+            offsets = np.arange(start, start + window)
+            _accumulate_window(sums, components, data[start:start + window],
+                               offsets - newest, np.ones(window))
+        else:
+            # Remove the samples leaving the window and add those entering it
+            offsets = np.concatenate([np.arange(start - step, start),
+                                      np.arange(start - step + window, start + window)])
+            _accumulate_window(sums, components, data[offsets], offsets - newest,
+                               np.repeat([-1., 1.], step))
+
+        # Shift the weights to end at this window (exponential weights are
+        # scale free and hann rates have period window - 1), then sum them
+        total, mean = 0, 0
+        terms = []
+        for (a, rate), (total_c, mean_c, outer_c) in zip(components, sums):
+            shift = a * rate ** (newest - start - window + 1)
+            total = total + np.real(shift * total_c)
+            mean = mean + np.real(shift * mean_c)
+            terms += zip(outer_c, [np.real(shift), -np.imag(shift)])
+        np.multiply(terms[0][0], terms[0][1], out=cov)
+        for outer, coef in terms[1:]:
+            axpy(outer.ravel(), cov.ravel(), a=coef)
+
+        # Covariance up to a factor, scaled to correlation
+        ger(-1 / total, mean, mean, a=cov.T, overwrite_a=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = 1 / np.sqrt(np.diag(cov))
+            cov *= scale
+            cov.T[...] *= scale
+        out[w] = cov[triu]
+    return Adjacency(out, matrix_type='similarity_flat')
+
+
 def align(data, method='deterministic_srm', n_features=None, axis=0,
           *args, **kwargs):
     ''' Align subject data into a common response model.
@@ -1045,7 +2064,7 @@ def align(data, method='deterministic_srm', n_features=None, axis=0,
 
     '''
 
-    from nltools.data import Brain_Data, Adjacency
+    from nltools.data import Brain_Data
 
     if not isinstance(data, list):
         raise ValueError('Make sure you are inputting data is a list.')
@@ -1151,10 +2170,8 @@ def align(data, method='deterministic_srm', n_features=None, axis=0,
     if n_features is None:
         n_features = out['common_model'].shape[0]
 
-    a = Adjacency()
-    for f in range(n_features):
-        a = a.append(Adjacency(1-pairwise_distances(np.array([x[f,:] for x in out['transformed']]), metric='correlation'), metric='similarity'))
-    out['isc'] = dict(zip(np.arange(n_features), a.mean(axis=1)))
+    stack = np.stack([x[:n_features, :].T for x in out['transformed']])
+    out['isc'] = dict(zip(np.arange(n_features), isc(stack)['isc']))
 
     if data_type == 'Brain_Data':
         for i, x in enumerate(out['transformed']):
@@ -1301,10 +2318,182 @@ def u_center(mat):
     return out
 
 
+def _abs_diff_row_sums(x):
+    """ Row sums of the distance matrices |x_i - x_j| of each column of x
+        (n,) or (n, n_columns), in O(n log n) from sorted prefix sums.
+    """
+    order = np.argsort(x, axis=0, kind='stable')
+    x_sorted = np.take_along_axis(x, order, axis=0)
+    before = np.cumsum(x_sorted, axis=0) - x_sorted
+    rank = np.arange(len(x)).reshape((-1,) + (1,) * (x.ndim - 1))
+    sums = x_sorted * (2 * rank - len(x)) + x_sorted.sum(axis=0) - 2 * before
+    out = np.empty_like(sums)
+    np.put_along_axis(out, order, sums, axis=0)
+    return out
+
+
+def _abs_diff_square_sums(x):
+    """ Sum of the squared distance matrix (x_i - x_j)**2 of each column. """
+    return 2 * len(x) * ((x - x.mean(axis=0)) ** 2).sum(axis=0)
+
+
+def _dominance_sums(data, weights):
+    """ For each i, sum the rows of weights (n, n_weights) over j < i with
+        data[j] <= data[i], where data is an integer array with values in
+        [0, n), by a bottom-up merge sort.
+    """
+    n = len(data)
+    size = 1 << int(np.ceil(np.log2(max(n, 2))))
+    # Padding with the largest value at the end adds to no real element
+    data = np.concatenate([data, np.full(size - n, n)])
+    weights = np.concatenate([weights, np.zeros((size - n, weights.shape[1]))])
+    index = np.arange(size)
+    out = np.zeros(weights.shape)
+    width = 1
+    while width < size:
+        shape = (size // (2 * width), 2 * width)
+        # Merge the sorted halves of each block. As the merge is stable, the
+        # left elements before a right element are those less than or equal
+        # to it, so the running sum of left weights is its dominance sum.
+        order = np.argsort(data.reshape(shape), axis=1, kind='stable')
+        index = np.take_along_axis(index.reshape(shape), order, axis=1)
+        weights = np.take_along_axis(weights.reshape(shape + (-1,)),
+                                     order[:, :, np.newaxis], axis=1)
+        left = (order < width)[:, :, np.newaxis]
+        running = np.cumsum(np.where(left, weights, 0), axis=1)
+        out[index[~left[:, :, 0]]] += running[~left[:, :, 0]]
+        data = np.take_along_axis(data.reshape(shape), order, axis=1).ravel()
+        index = index.ravel()
+        weights = weights.reshape(size, -1)
+        width *= 2
+    return out[:n]
+
+
+def _distance_sums_1d(x, y):
+    """ Distance matrix sums of 1d x and y in O(n log n) (Huo & Szekely, 2016).
+
+    Σ_ij |x_i - x_j||y_i - y_j| is twice the sum over pairs j < i in x order of
+    sign(y_i - y_j)(x_i - x_j)(y_i - y_j), which expands into dominance sums
+    of 1, y, x and xy. Ties contribute zero whichever sign they are given.
+    """
+    x = x - x.mean()
+    y = y - y.mean()
+    order = np.argsort(x, kind='stable')
+    x_sorted, y_sorted = x[order], y[order]
+    weights = np.column_stack([np.ones(len(x)), y_sorted, x_sorted,
+                               x_sorted * y_sorted])
+    ranks = (rankdata(y_sorted, method='dense') - 1).astype(int)
+    signed = (2 * _dominance_sums(ranks, weights) -
+              (np.cumsum(weights, axis=0) - weights))
+    ab = 2 * (x_sorted * y_sorted * signed[:, 0] - x_sorted * signed[:, 1] -
+              y_sorted * signed[:, 2] + signed[:, 3]).sum()
+    return (_abs_diff_row_sums(x), _abs_diff_row_sums(y), ab,
+            _abs_diff_square_sums(x), _abs_diff_square_sums(y))
+
+
+def _distance_sums(x, y, max_elements=2**22):
+    """ Row sums of the euclidean distance matrices a and b of the rows of x
+        (n, p) and y (n, q), together with the sums of a * b, a * a and b * b,
+        accumulated over blocks of rows so that no n x n matrix is stored.
+    """
+    if x.shape[1] == 1 and y.shape[1] == 1:
+        return _distance_sums_1d(x[:, 0], y[:, 0])
+    n = x.shape[0]
+    a_rows, b_rows = np.zeros(n), np.zeros(n)
+    ab = aa = bb = 0
+    block = _block_size(n, max_elements)
+    for start in range(0, n, block):
+        rows = slice(start, start + block)
+        a = cdist(x[rows], x)
+        b = cdist(y[rows], y)
+        a_rows[rows] = a.sum(axis=1)
+        b_rows[rows] = b.sum(axis=1)
+        ab += np.einsum('ij,ij->', a, b)
+        aa += np.einsum('ij,ij->', a, a)
+        bb += np.einsum('ij,ij->', b, b)
+    return a_rows, b_rows, ab, aa, bb
+
+
+def _distance_sums_columns(x, y, max_elements=2**22):
+    """ Like _distance_sums but between x (n, p) and each column of y
+        (n, n_columns), with y statistics returned per column.
+    """
+    n, n_columns = y.shape
+    b_rows = _abs_diff_row_sums(y)
+    bb = _abs_diff_square_sums(y)
+    ab = np.zeros(n_columns)
+    n_chunk = min(n_columns, max(1, max_elements // n))
+    block = max(1, max_elements // (n * n_chunk))
+    a_rows = np.zeros(n)
+    aa = 0
+    for start in range(0, n, block):
+        rows = slice(start, start + block)
+        a = cdist(x[rows], x)
+        a_rows[rows] = a.sum(axis=1)
+        aa += np.einsum('ij,ij->', a, a)
+        for col in range(0, n_columns, n_chunk):
+            cols = slice(col, col + n_chunk)
+            b = np.abs(y[rows, np.newaxis, cols] - y[np.newaxis, :, cols])
+            ab[cols] += np.einsum('ij,ijk->k', a, b)
+    return a_rows[:, np.newaxis], b_rows, ab, aa, bb
+
+
+def _centered_product(a_rows, b_rows, ab, n, bias_corrected=True):
+    """ Inner product of two u-centered (or double-centered) distance
+        matrices, divided by n(n - 3) (or n**2), from their row sums and the
+        sum of their elementwise product (Szekely & Rizzo, 2014).
+    """
+    rows = (a_rows * b_rows).sum(axis=0)
+    total = a_rows.sum(axis=0) * b_rows.sum(axis=0)
+    if bias_corrected:
+        return (ab - 2 * rows / (n - 2) +
+                total / ((n - 1) * (n - 2))) / (n * (n - 3))
+    return (ab - 2 * rows / n + total / n ** 2) / n ** 2
+
+
+def _distance_correlation_stats(a_rows, b_rows, ab, aa, bb, n,
+                                bias_corrected=True, return_all_stats=False):
+    """ Distance correlation results from the sums of _distance_sums. """
+    xy = _centered_product(a_rows, b_rows, ab, n, bias_corrected)
+    xx = _centered_product(a_rows, a_rows, aa, n, bias_corrected)
+    yy = _centered_product(b_rows, b_rows, bb, n, bias_corrected)
+    xx = np.broadcast_to(xx, np.shape(xy))
+
+    # Normalize to get correlation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = np.sqrt(xx)
+        var_y = np.sqrt(yy)
+        denom = np.sqrt(xx * yy)
+        r2 = np.where(denom > 0, xy / denom, 0)
+        # Windsorize negative values as a result of u-centering
+        cor = np.where(r2 > 0, np.sqrt(np.abs(r2)), 0)
+
+    out = {}
+    out['d_correlation_adjusted'] = cor[()]
+
+    if return_all_stats:
+        out['d_covariance_squared'] = xy[()]
+        out['d_correlation_adjusted'] = r2[()]
+        out['x_var'] = var_x[()]
+        out['y_var'] = var_y[()]
+
+    if bias_corrected:
+        dof = (n * (n - 3) / 2) - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.sqrt(dof) * (r2 / np.sqrt(1 - r2**2))
+        out['t'] = t[()]
+        out['p'] = (1 - t_dist.cdf(t, dof))[()]
+        out['df'] = dof
+
+    return out
+
+
 def distance_correlation(x, y, bias_corrected=True, return_all_stats=False):
     '''Compute the distance correlation betwen 2 arrays.
         Distance correlation involves computing the normalized covariance of two centered euclidean distance matrices. Each distance matrix is the euclidean distance between rows (if x or y are 2d) or scalars (if x or y are 1d). Each matrix is centered using u-centering, a bias-corrected form of double-centering. This permits inference of the normalized covariance between each distance matrix using a one-tailed directional t-test. (Szekely & Rizzo, 2013). While distance correlation is normally bounded between 0 and 1, u-centering can produce negative estimates, which are never significant. Therefore these estimates are windsorized to 0, ala Geerligs, Cam-CAN, Henson, 2016.
 
+        The centered covariances are computed from the row sums of each distance matrix, accumulated over blocks of rows, so memory grows linearly with the number of observations. When x and y are both 1d an O(n log n) algorithm is used (Huo & Szekely, 2016).
+
     Args:
         x (ndarray): 1d or 2d numpy array of observations by features
         y (ndarry): 1d or 2d numpy array of observations by features
@@ -1317,77 +2506,102 @@ def distance_correlation(x, y, bias_corrected=True, return_all_stats=False):
 
     if len(x.shape) > 2 or len(y.shape) > 2:
         raise ValueError("Both arrays must be 1d or 2d")
+    if x.shape[0] != y.shape[0]:
+        raise ValueError("Both arrays must have the same number of observations")
 
-    # 1 compute euclidean distances between pairs of value in each array
-    if len(x.shape) == 1:
-        _x = x[:, np.newaxis]
-    else:
-        _x = x
-    if len(y.shape) == 1:
-        _y = y[:, np.newaxis]
-    else:
-        _y = y
+    _x = np.asarray(x, dtype=float).reshape(x.shape[0], -1)
+    _y = np.asarray(y, dtype=float).reshape(y.shape[0], -1)
+    return _distance_correlation_stats(*_distance_sums(_x, _y), _x.shape[0],
+                                       bias_corrected=bias_corrected,
+                                       return_all_stats=return_all_stats)
 
-    x_dist = squareform(pdist(_x))
-    y_dist = squareform(pdist(_y))
 
-    # 2 center each matrix
-    if bias_corrected:
-        # U-centering
-        x_dist_cent = u_center(x_dist)
-        y_dist_cent = u_center(y_dist)
-        # Compute covariances using N*(N-3) in denominator
-        adjusted_n = _x.shape[0] * (_x.shape[0]-3)
-        xy = np.multiply(x_dist_cent, y_dist_cent).sum() / adjusted_n
-        xx = np.multiply(x_dist_cent, x_dist_cent).sum() / adjusted_n
-        yy = np.multiply(y_dist_cent, y_dist_cent).sum() / adjusted_n
-    else:
-        # double-centering
-        x_dist_cent = double_center(x_dist)
-        y_dist_cent = double_center(y_dist)
-        # Compute covariances using N^2 in denominator
-        xy = np.multiply(x_dist_cent, y_dist_cent).mean()
-        xx = np.multiply(x_dist_cent, x_dist_cent).mean()
-        yy = np.multiply(y_dist_cent, y_dist_cent).mean()
-
-    # 3 compute covariances and variances
-    var_x = np.sqrt(xx)
-    var_y = np.sqrt(yy)
-
-    # 4 Normalize to get correlation
-    denom = np.sqrt(xx * yy)
-    if denom > 0:
-        r2 = xy / denom
-    else:
-        r2 = 0
-    # Windsorize negative values as a result of u-centering
-    if r2 > 0:
-        cor = np.sqrt(r2)
+def distance_correlation_batch(x, y, bias_corrected=True,
+                               return_all_stats=False):
+    '''Compute the distance correlation between one array and many others,
+        e.g., a stimulus feature and every voxel or ROI. Statistics of x are
+        computed once and the distance matrices are never stored in full.
+        See distance_correlation for details.
+
+    Args:
+        x (ndarray): 1d or 2d numpy array of observations by features
+        y (ndarray, Brain_Data, list): 2d numpy array or Brain_Data of observations by variables, where each column (e.g., voxel) is a separate 1d variable, or a list of 1d or 2d arrays of observations by features (e.g., ROIs)
+        bias_corrected (bool): if false use double-centering but no inference test is performed, if true use u-centering and perform inference; default True
+        return_all_stats (bool): if true return distance covariance and variances of each array as well; default False
+
+    Returns:
+        results (dict): dictionary of arrays of results with one value per variable in y (correlation, t, p, and df.) Optionally, covariance, x variance, and y variance
+    '''
+    from nltools.data import Brain_Data
+
+    if len(x.shape) > 2:
+        raise ValueError("x must be 1d or 2d")
+    _x = np.asarray(x, dtype=float).reshape(x.shape[0], -1)
+    n = _x.shape[0]
+
+    if isinstance(y, Brain_Data):
+        y = y.data
+    if isinstance(y, (list, tuple)):
+        if any(len(d.shape) > 2 or d.shape[0] != n for d in y):
+            raise ValueError("Each array in y must be 1d or 2d with the same "
+                             "number of observations as x")
+        sums = [_distance_sums(_x, np.asarray(d, dtype=float).reshape(n, -1))
+                for d in y]
+        a_rows = sums[0][0][:, np.newaxis] if sums else np.zeros((n, 1))
+        b_rows = np.column_stack([s[1] for s in sums]) if sums else np.zeros((n, 0))
+        ab, aa, bb = [np.array([s[i] for s in sums]) for i in (2, 3, 4)]
+        aa = aa[0] if len(aa) else 0
     else:
-        cor = 0
+        y = np.asarray(y, dtype=float)
+        if y.ndim != 2 or y.shape[0] != n:
+            raise ValueError("y must be 2d with the same number of "
+                             "observations as x")
+        a_rows, b_rows, ab, aa, bb = _distance_sums_columns(_x, y)
+    return _distance_correlation_stats(a_rows, b_rows, ab, aa, bb, n,
+                                       bias_corrected=bias_corrected,
+                                       return_all_stats=return_all_stats)
+
+
+def _procrustes_standardize(mat):
+    """ Center the columns of a matrix and scale it to unit Frobenius norm,
+        as in scipy.spatial.procrustes.
+    """
+    mat = np.array(mat, dtype=float)
+    mat -= np.mean(mat, axis=0)
+    norm = np.linalg.norm(mat)
+    if norm == 0:
+        raise ValueError("Input matrices must contain >1 unique points")
+    return mat / norm
 
-    out = {}
-    out['d_correlation_adjusted'] = cor
 
-    if return_all_stats:
-        out['d_covariance_squared'] = xy
-        out['d_correlation_adjusted'] = r2
-        out['x_var'] = var_x
-        out['y_var'] = var_y
+def _nuclear_norm(cross, method='svd'):
+    """ Sum of the singular values of each matrix in a stack of cross-product
+        matrices, either by SVD or from the eigenvalues of cross.T @ cross.
+    """
+    if method == 'svd':
+        return np.linalg.svd(cross, compute_uv=False).sum(axis=-1)
+    elif method == 'eig':
+        gram = np.matmul(np.swapaxes(cross, -1, -2), cross)
+        return np.sqrt(np.clip(np.linalg.eigvalsh(gram), 0, None)).sum(axis=-1)
+    else:
+        raise ValueError("method must be ['svd', 'eig']")
 
-    if bias_corrected:
-        dof = (adjusted_n / 2) - 1
-        t = np.sqrt(dof) * (r2 / np.sqrt(1 - r2**2))
-        p = 1-t_dist.cdf(t, dof)
-        out['t'] = t
-        out['p'] = p
-        out['df'] = dof
 
-    return out
+def _permute_procrustes(mat1, mat2, n_permute, method='svd',
+                        random_state=None):
+    """ Procrustes similarity of standardized matrices with the rows of mat1
+        permuted. Row permutations leave the standardization unchanged, so
+        each permutation reduces to the nuclear norm of a small cross-product.
+    """
+    random_state = check_random_state(random_state)
+    perm_ix = np.argsort(random_state.rand(n_permute, mat1.shape[0]), axis=1)
+    cross = np.matmul(np.swapaxes(mat1[perm_ix], 1, 2), mat2)
+    return _nuclear_norm(cross, method=method) ** 2
 
 
-def procrustes_distance(mat1, mat2, n_permute=5000, tail=2, n_jobs=-1, random_state=None):
-    """ Use procrustes super-position to perform a similarity test between 2 matrices. Matrices need to match in size on their first dimension only, as the smaller matrix on the second dimension will be padded with zeros. After aligning two matrices using the procrustes transformation, use the computed disparity between them (sum of squared error of elements) as a similarity metric. Shuffle the rows of one of the matrices and recompute the disparity to perform inference (Peres-Neto & Jackson, 2001).
+def procrustes_distance(mat1, mat2, n_permute=5000, tail=2, n_jobs=-1,
+                        random_state=None, method='svd'):
+    """ Use procrustes super-position to perform a similarity test between 2 matrices. Matrices need to match in size on their first dimension only, as the smaller matrix on the second dimension will be padded with zeros. After aligning two matrices using the procrustes transformation, use the computed disparity between them (sum of squared error of elements) as a similarity metric. Shuffle the rows of one of the matrices and recompute the disparity to perform inference (Peres-Neto & Jackson, 2001). Both matrices are standardized once and each permutation only requires the singular values of a small cross-product matrix, computed in blocks.
 
     Args:
         mat1 (ndarray): 2d numpy array; must have same number of rows as mat2
@@ -1395,6 +2609,9 @@ def procrustes_distance(mat1, mat2, n_permute=5000, tail=2, n_jobs=-1, random_st
         n_permute (int): number of permutation iterations to perform
         tail (int): either 1 for one-tailed or 2 for two-tailed test; default 2
         n_jobs (int): The number of CPUs to use to do permutation; default -1 (all)
+        method (str): compute singular values with 'svd' or, faster for
+                      many columns, from the eigenvalues of the cross-product
+                      with 'eig'; default 'svd'
 
     Returns:
         similarity (float): similarity between matrices bounded between 0 and 1
@@ -1402,12 +2619,9 @@ def procrustes_distance(mat1, mat2, n_permute=5000, tail=2, n_jobs=-1, random_st
 
     """
 
-    #raise NotImplementedError("procrustes distance is not currently implemented")
     if mat1.shape[0] != mat2.shape[0]:
         raise ValueError('Both arrays must match on their first dimension')
 
-    random_state = check_random_state(random_state)
-
     # Make sure both matrices are 2d and the same dimension via padding
     if len(mat1.shape) < 2:
         mat1 = mat1[:, np.newaxis]
@@ -1418,19 +2632,79 @@ def procrustes_distance(mat1, mat2, n_permute=5000, tail=2, n_jobs=-1, random_st
     elif mat2.shape[1] > mat1.shape[1]:
         mat1 = np.pad(mat1, ((0, 0), (0, mat2.shape[1] - mat1.shape[1])), 'constant')
 
-    _, _, sse = procrust(mat1, mat2)
+    mat1 = _procrustes_standardize(mat1)
+    mat2 = _procrustes_standardize(mat2)
 
     stats = dict()
-    stats['similarity'] = sse
+    stats['similarity'] = _nuclear_norm(np.dot(mat1.T, mat2),
+                                        method=method) ** 2
 
-    all_p = Parallel(n_jobs=n_jobs)(delayed(procrust)(random_state.permutation(mat1), mat2) for i in range(n_permute))
-    all_p = [1 - x[2] for x in all_p]
+    all_p = _permute_blocks(_permute_procrustes, n_permute,
+                            _block_size(mat1.size + mat1.shape[1] ** 2),
+                            n_jobs=n_jobs, random_state=random_state,
+                            mat1=mat1, mat2=mat2, method=method)
 
-    stats['p'] = _calc_pvalue(all_p, sse, tail)
+    stats['p'] = _calc_pvalue(all_p, stats['similarity'], tail)
 
     return stats
 
-def find_spikes(data, global_spike_cutoff=3, diff_spike_cutoff=3):
+
+def _frame_stats_nifti(data, chunk_size=16):
+    '''Helper function for find_spikes. Streams over volumes of a 4D nibabel
+        image in chunks and returns the global mean of each volume and the
+        mean absolute difference between successive volumes without loading
+        the whole image into memory.
+    '''
+    if len(data.shape) != 4:
+        raise ValueError('nibabel instance does not appear to be 4D data.')
+
+    n_tr = data.shape[3]
+    global_mn = np.zeros(n_tr)
+    frame_diff = np.zeros(max(n_tr - 1, 0))
+    previous = None
+    for start in range(0, n_tr, chunk_size):
+        stop = min(start + chunk_size, n_tr)
+        chunk = np.asarray(data.dataobj[..., start:stop], dtype=np.float64)
+        chunk = chunk.reshape(-1, stop - start)
+        global_mn[start:stop] = chunk.mean(axis=0)
+        if previous is not None:
+            frame_diff[start - 1] = np.mean(np.abs(chunk[:, 0] - previous))
+        if stop - start > 1:
+            frame_diff[start:stop - 1] = np.mean(np.abs(np.diff(chunk, axis=1)), axis=0)
+        previous = chunk[:, -1].copy()
+    return global_mn, frame_diff
+
+
+def _frame_stats_array(data, chunk_size=16):
+    '''Helper function for find_spikes. Returns the global mean of each
+        image (row) and the mean absolute difference between successive
+        images, computed in chunks of images with one reused buffer instead
+        of a full difference array.
+    '''
+    data = np.atleast_2d(data)
+    n_tr = data.shape[0]
+    frame_diff = np.zeros(max(n_tr - 1, 0))
+    buffer = np.empty((min(chunk_size, max(n_tr - 1, 1)), data.shape[1]),
+                      dtype=data.dtype)
+    for start in range(0, n_tr - 1, chunk_size):
+        stop = min(start + chunk_size, n_tr - 1)
+        diff = buffer[:stop - start]
+        np.subtract(data[start + 1:stop + 1], data[start:stop], out=diff)
+        np.abs(diff, out=diff)
+        frame_diff[start:stop] = diff.mean(axis=1)
+    return data.mean(axis=1), frame_diff
+
+
+def _find_outliers(x, cutoff):
+    '''Helper function for find_spikes. Returns indices above, then below,
+        mean +/- cutoff standard deviations.'''
+    mn, sd = np.mean(x), np.std(x)
+    return np.append(np.where(x > mn + sd * cutoff)[0],
+                     np.where(x < mn - sd * cutoff)[0])
+
+
+def find_spikes(data, global_spike_cutoff=3, diff_spike_cutoff=3,
+                sampling_freq=None):
     '''Function to identify spikes from fMRI Time Series Data
 
         Args:
@@ -1439,47 +2713,41 @@ def find_spikes(data, global_spike_cutoff=3, diff_spike_cutoff=3):
                                  in standard deviations, None indicates do not calculate.
             diff_spike_cutoff: (int,None) cutoff to identify spikes in average frame difference
                                  in standard deviations, None indicates do not calculate.
+            sampling_freq: (float) sampling frequency of data in hertz, set on
+                           the returned Design_Matrix so it can be appended to
+                           other design matrices; default None
         Returns:
-            pandas dataframe with spikes as indicator variables
+            Design_Matrix with spikes as indicator variables
     '''
 
-    from nltools.data import Brain_Data
+    from nltools.data import Brain_Data, Design_Matrix
 
     if (global_spike_cutoff is None) & (diff_spike_cutoff is None):
         raise ValueError('Did not input any cutoffs to identify spikes in this data.')
 
     if isinstance(data, Brain_Data):
-        data = deepcopy(data.data)
-        global_mn = np.mean(data.data, axis=1)
-        frame_diff = np.mean(np.abs(np.diff(data.data, axis=0)), axis=1)
+        global_mn, frame_diff = _frame_stats_array(data.data)
     elif isinstance(data, nib.Nifti1Image):
-        data = deepcopy(data.get_data())
-        if len(data.shape) > 3:
-            data = np.squeeze(data)
-        elif len(data.shape) < 3:
-            raise ValueError('nibabel instance does not appear to be 4D data.')
-        global_mn = np.mean(data, axis=(0,1,2))
-        frame_diff = np.mean(np.abs(np.diff(data, axis=3)), axis=(0,1,2))
+        global_mn, frame_diff = _frame_stats_nifti(data)
     else:
         raise ValueError('Currently this function can only accomodate Brain_Data and nibabel instances')
 
+    columns = []
+    locs = []
     if global_spike_cutoff is not None:
-        global_outliers = np.append(np.where(global_mn > np.mean(global_mn) + np.std(global_mn) * global_spike_cutoff),
-                                    np.where(global_mn < np.mean(global_mn) - np.std(global_mn) * global_spike_cutoff))
+        global_outliers = _find_outliers(global_mn, global_spike_cutoff)
+        columns += ['global_spike' + str(i + 1) for i in range(len(global_outliers))]
+        locs.append(global_outliers)
 
     if diff_spike_cutoff is not None:
-        frame_outliers = np.append(np.where(frame_diff > np.mean(frame_diff) + np.std(frame_diff) * diff_spike_cutoff),
-                                   np.where(frame_diff < np.mean(frame_diff) - np.std(frame_diff) * diff_spike_cutoff))
-   # build spike regressors
-    outlier = pd.DataFrame([x+1 for x in range(len(global_mn))],columns=['TR'])
-    if (global_spike_cutoff is not None):
-        for i, loc in enumerate(global_outliers):
-            outlier['global_spike' + str(i + 1)] = 0
-            outlier['global_spike' + str(i + 1)].iloc[int(loc)] = 1
-
-    # build FD regressors
-    if (diff_spike_cutoff is not None):
-        for i, loc in enumerate(frame_outliers):
-            outlier['diff_spike' + str(i + 1)] = 0
-            outlier['diff_spike' + str(i + 1)].iloc[int(loc)] = 1
-    return outlier
+        frame_outliers = _find_outliers(frame_diff, diff_spike_cutoff)
+        columns += ['diff_spike' + str(i + 1) for i in range(len(frame_outliers))]
+        locs.append(frame_outliers)
+
+    # build spike regressors in a single allocation
+    locs = np.concatenate(locs).astype(int)
+    spikes = np.zeros((len(global_mn), len(locs) + 1), dtype=int)
+    spikes[:, 0] = np.arange(1, len(global_mn) + 1)
+    spikes[locs, np.arange(1, len(locs) + 1)] = 1
+    return Design_Matrix(spikes, columns=['TR'] + columns,
+                         sampling_freq=sampling_freq)
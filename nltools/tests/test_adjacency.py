@@ -1,10 +1,16 @@
 import os
 import numpy as np
+import pandas as pd
 from nltools.data import Adjacency, Design_Matrix
+from nltools.utils import concatenate
 import matplotlib.pyplot as plt
 import networkx as nx
 from scipy.stats import pearsonr
 from scipy.linalg import block_diag
+from scipy.sparse import csr_matrix
+from sklearn.covariance import LedoitWolf, OAS
+import pytest
+from nltools.stats import one_sample_permutation, regress as regression
 
 
 def test_type_single(sim_adjacency_single):
@@ -18,6 +24,58 @@ def test_type_directed(sim_adjacency_directed):
     assert not sim_adjacency_directed.issymmetric
 
 
+def test_from_timeseries():
+    rng = np.random.RandomState(0)
+    data = [rng.randn(n, 6).dot(rng.randn(6, 6)) for n in [30, 40, 50]]
+    i, j = np.triu_indices(6, k=1)
+
+    out = Adjacency.from_timeseries(data)
+    assert out.matrix_type == 'similarity'
+    assert out.data.shape == (3, 15)
+    assert np.allclose(out.data[1], np.corrcoef(data[1].T)[i, j])
+
+    for estimator, sk_estimator in [('ledoit_wolf', LedoitWolf()), ('oas', OAS())]:
+        out = Adjacency.from_timeseries(data, estimator=estimator,
+                                        kind='partial_correlation')
+        precision = np.linalg.inv(sk_estimator.fit(data[2]).covariance_)
+        scale = 1 / np.sqrt(np.diag(precision))
+        partial = -precision * np.outer(scale, scale)
+        assert np.allclose(out.data[2], partial[i, j])
+
+    with pytest.raises(ValueError):
+        Adjacency.from_timeseries(data, estimator='graphical_lasso')
+    with pytest.raises(ValueError):
+        Adjacency.from_timeseries(data[0])
+
+
+def test_from_stack():
+    rng = np.random.RandomState(0)
+    sim = rng.rand(4, 6, 6)
+    sim = (sim + sim.transpose(0, 2, 1))/2
+    sim[:, np.arange(6), np.arange(6)] = 1
+    dist = 1 - sim
+    directed = rng.rand(4, 6, 6)
+    for stack, matrix_type in [(sim, 'similarity'), (dist, 'distance'),
+                               (directed, 'directed')]:
+        dat = Adjacency.from_stack(stack)
+        expected = Adjacency(list(stack))
+        assert dat.matrix_type == expected.matrix_type == matrix_type
+        assert dat.issymmetric == expected.issymmetric
+        assert not dat.is_single_matrix
+        assert np.array_equal(dat.data, expected.data)
+    assert np.allclose(Adjacency.from_stack(directed)[1].squareform(),
+                       directed[1])
+    trusted = Adjacency.from_stack(directed, matrix_type='similarity',
+                                   validate=False)
+    assert trusted.data.shape == (4, 15)
+    with pytest.raises(ValueError):
+        Adjacency.from_stack(directed, matrix_type='similarity')
+    with pytest.raises(ValueError):
+        Adjacency.from_stack(np.concatenate([sim, dist]))
+    with pytest.raises(ValueError):
+        Adjacency.from_stack(sim[0])
+
+
 def test_length(sim_adjacency_multiple):
     assert len(sim_adjacency_multiple) == sim_adjacency_multiple.data.shape[0]
     assert len(sim_adjacency_multiple[0]) == 1
@@ -86,6 +144,20 @@ def test_similarity(sim_adjacency_multiple):
     assert len(sim_adjacency_multiple.similarity(sim_adjacency_multiple[0].squareform(), perm_type='1d',
                                                  metric='kendall', n_permute=n_permute)) == len(sim_adjacency_multiple)
 
+    rng = np.random.RandomState(0)
+    model = sim_adjacency_multiple[0].squareform()
+    noisy = Adjacency([model + x * .1 for x in
+                       rng.randn(5, *model.shape)], matrix_type='distance')
+    for perm_type in ['1d', '2d']:
+        out = noisy.similarity(model, perm_type=perm_type, n_permute=n_permute,
+                               random_state=0)
+        assert isinstance(out, pd.DataFrame)
+        assert list(out.columns) == ['correlation', 'p']
+        expected = [x.similarity(model, perm_type=perm_type,
+                                 n_permute=n_permute) for x in noisy]
+        assert np.allclose(out['correlation'],
+                           [x['correlation'] for x in expected])
+
     data2 = sim_adjacency_multiple[0].copy()
     data2.data = data2.data + np.random.randn(len(data2.data))*.1
     assert sim_adjacency_multiple[0].similarity(data2.squareform(), perm_type=None, n_permute=n_permute)['correlation'] > .5
@@ -122,6 +194,52 @@ def test_ttest(sim_adjacency_multiple):
     assert out['p'].shape()[0] == sim_adjacency_multiple.shape()[1]
 
 
+def test_ttest_permutation():
+    rng = np.random.RandomState(0)
+    n_nodes = 12
+    data = rng.randn(15, n_nodes * (n_nodes - 1) // 2)
+    # Effect on the edges among the first four nodes
+    block = np.zeros((n_nodes, n_nodes))
+    block[:4, :4] = 1
+    effect = block[np.triu_indices(n_nodes, k=1)] == 1
+    data[:, effect] += 2
+    dat = Adjacency(data, matrix_type='similarity_flat')
+    out = dat.ttest(permutation=True, n_permute=1000, fwe=True,
+                    nbs_threshold=3, random_state=0)
+    expected = one_sample_permutation(data, n_permute=1000, random_state=0)
+    assert np.allclose(out['t'].data, expected['mean'])
+    assert np.allclose(out['p'].data, expected['p'])
+    assert np.all(out['p_fwe'].data >= out['p'].data)
+    assert np.all(out['p_fwe'].data[effect] < .05)
+    assert out['nbs']['size'][0] == effect.sum()
+    assert out['nbs']['p'][0] < .05
+    assert np.array_equal(out['nbs']['components'].data == 1, effect)
+    with pytest.raises(ValueError):
+        dat.ttest(fwe=True)
+
+
+def test_nbs():
+    rng = np.random.RandomState(0)
+    n_nodes = 12
+    group = np.repeat([0, 1], 10)
+    data = rng.randn(len(group), n_nodes * (n_nodes - 1) // 2)
+    block = np.zeros((n_nodes, n_nodes))
+    block[:4, :4] = 1
+    effect = block[np.triu_indices(n_nodes, k=1)] == 1
+    data[np.ix_(group == 1, effect)] += 3
+    dat = Adjacency(data, matrix_type='similarity_flat')
+    design = Design_Matrix({'Intercept': np.ones(len(group)), 'Group': group})
+    out = dat.nbs(design, threshold=3, n_permute=500, random_state=0)
+    _, t, _, _, _ = regression(design, data)
+    assert np.allclose(out['t'].data, t[1])
+    assert out['size'][0] == effect.sum()
+    assert out['p'][0] < .05
+    assert np.all(out['p'][1:] > .05)
+    assert np.array_equal(out['components'].data == 1, effect)
+    with pytest.raises(ValueError):
+        dat.nbs(design[:5], threshold=3)
+
+
 def test_threshold(sim_adjacency_directed):
     assert np.sum(sim_adjacency_directed.threshold(upper=.8).data == 0) == 10
     assert sim_adjacency_directed.threshold(upper=.8, binarize=True).data[0]
@@ -129,6 +247,74 @@ def test_threshold(sim_adjacency_directed):
     assert np.sum(sim_adjacency_directed.threshold(lower=.4, binarize=True).data) == 6
 
 
+def test_sparse(sim_adjacency_multiple, sim_adjacency_directed, tmpdir):
+    dense = sim_adjacency_multiple
+    sparse = Adjacency(dense.squareform(), sparse=True)
+    assert sparse.issparse()
+    assert sparse.shape() == dense.shape()
+    assert sparse.square_shape() == dense.square_shape()
+    assert np.allclose(sparse[1].squareform(), dense[1].squareform())
+    assert np.allclose(sparse[1].squareform(sparse=True).toarray(),
+                       dense[1].squareform(sparse=True).toarray())
+    assert np.allclose(sparse.mean().to_dense().data, dense.mean().data)
+    assert np.allclose(sparse.mean(axis=1), dense.mean(axis=1))
+    assert (sparse + sparse).issparse()
+    assert (sparse * 2).issparse()
+    assert not (sparse + 1).issparse()
+    assert np.allclose((sparse - dense).data, 0)
+    assert np.allclose((sparse * sparse).to_dense().data, (dense * dense).data)
+
+    assert not dense.threshold(upper=2).issparse()
+    thresholded = dense.threshold(upper='95%', binarize=True, sparse=True)
+    assert thresholded.issparse()
+    assert np.allclose(thresholded.to_dense().data,
+                       dense.threshold(upper='95%', binarize=True).data)
+    assert sparse.threshold(upper='95%').issparse()
+    assert np.allclose(sparse.threshold(upper='95%').to_dense().data,
+                       dense.threshold(upper='95%').data)
+
+    # Methods expecting arrays work on sparse data
+    unlabeled = Adjacency(dense.data, matrix_type='distance_flat')
+    expected = unlabeled.threshold(upper='95%')
+    for adj in [expected, unlabeled.threshold(upper='95%', sparse=True)]:
+        assert np.allclose(adj.ttest()['t'].data, expected.ttest()['t'].data,
+                           equal_nan=True)
+        assert np.allclose(adj.ttest(permutation=True, n_permute=100,
+                                     random_state=0)['p'].data,
+                           expected.ttest(permutation=True, n_permute=100,
+                                          random_state=0)['p'].data)
+        assert np.allclose(adj.distance().data, expected.distance().data)
+        assert np.allclose(adj.similarity(dense[0], perm_type=None)['correlation'],
+                           expected.similarity(dense[0], perm_type=None)['correlation'])
+        assert adj.bootstrap('mean', n_samples=5, random_state=0)['Z'].data.shape \
+            == dense[0].data.shape
+        assert np.allclose(adj[0].distance_to_similarity().data,
+                           expected[0].distance_to_similarity().data)
+        clusters = np.arange(adj.square_shape()[0]) % 2
+        assert adj[0].within_cluster_mean(clusters) == \
+            expected[0].within_cluster_mean(clusters)
+
+    directed = Adjacency(csr_matrix(sim_adjacency_directed.squareform()))
+    assert directed.matrix_type == 'directed'
+    assert np.allclose(directed.to_dense().data, sim_adjacency_directed.data)
+    graph = directed.to_graph()
+    assert isinstance(graph, nx.DiGraph)
+    assert nx.utils.graphs_equal(
+        graph, nx.DiGraph(sim_adjacency_directed.squareform()))
+    assert np.allclose(sparse.append(dense[0]).to_dense().data,
+                       dense.append(dense[0]).data)
+    stacked = Adjacency([sparse[0], sparse[1]])
+    assert stacked.issparse()
+    assert np.allclose(stacked.to_dense().data,
+                       Adjacency([dense[0], dense[1]]).data)
+    assert stacked.mean().square_shape() == dense.square_shape()
+    assert np.allclose(concatenate([sparse[0], dense[1]]).to_dense().data,
+                       concatenate([dense[0], dense[1]]).data)
+    sparse.write(os.path.join(str(tmpdir.join('Test.csv'))))
+    assert np.allclose(Adjacency(os.path.join(str(tmpdir.join('Test.csv'))),
+                                 matrix_type='distance_flat').data, dense.data)
+
+
 def test_graph_directed(sim_adjacency_directed):
     assert isinstance(sim_adjacency_directed.to_graph(), nx.DiGraph)
 
@@ -187,6 +373,8 @@ def test_regression():
 
     stats = Y.regress(X)
     assert np.allclose(stats['beta'], np.array([1, 2, 3]))
+    stats = Y.to_sparse().regress(X.to_sparse())
+    assert np.allclose(stats['beta'], np.array([1, 2, 3]))
 
     # Test Design_Matrix Regression
     n = 10
@@ -194,6 +382,10 @@ def test_regression():
                   matrix_type='similarity')
     X = Design_Matrix(np.ones(n))
     stats = d.regress(X)
+    sparse_stats = d.to_sparse().regress(X)
+    for key in ['beta', 't', 'p', 'residual']:
+        assert np.allclose(sparse_stats[key].data, stats[key].data,
+                           equal_nan=True)
     out = stats['beta'].within_cluster_mean(clusters=['Group1']*4 + ['Group2']*8)
     assert np.allclose(np.array([out['Group1'], out['Group2']]), np.array([1, 0]), rtol=1e-01)  # np.allclose(np.sum(stats['beta']-np.array([1,2,3])),0)
 
@@ -1,7 +1,9 @@
 import os
+import pytest
 import numpy as np
 import nibabel as nb
 import pandas as pd
+from nilearn.input_data import NiftiMasker
 from nltools.simulator import Simulator
 from nltools.data import (Brain_Data,
                           Adjacency,
@@ -9,6 +11,7 @@ from nltools.data import (Brain_Data,
 from nltools.stats import threshold, align
 from nltools.mask import create_sphere
 from nltools.utils import get_resource_path
+from nltools.file_reader import read_nifti_masked
 from nltools.mask import expand_mask
 # from nltools.prefs import MNI_Template
 
@@ -43,6 +46,27 @@ def test_load(tmpdir):
     # Test load list
     dat = Brain_Data(data=str(tmpdir.join('data.nii.gz')), Y=y)
 
+    # Test streamed reading matches NiftiMasker
+    masker = NiftiMasker(mask_img=dat.mask).fit()
+    np.testing.assert_array_equal(
+        dat.data, masker.transform(str(tmpdir.join('data.nii.gz'))))
+    sphere = create_sphere([0, 0, 0], radius=8)
+    masker = NiftiMasker(mask_img=sphere).fit()
+    np.testing.assert_array_equal(
+        read_nifti_masked(str(tmpdir.join('data.nii.gz')), sphere,
+                          n_volumes=4),
+        masker.transform(str(tmpdir.join('data.nii.gz'))))
+    # In-memory proxy images are read as they are, not reloaded from disk
+    img = nb.load(str(tmpdir.join('data.nii.gz')))
+    proxy = nb.arrayproxy.ArrayProxy(
+        img.get_filename(), (img.shape, img.dataobj.dtype, img.dataobj.offset,
+                             2., 1.))
+    scaled = nb.Nifti1Image(proxy, img.affine, img.header)
+    scaled.set_filename(img.get_filename())
+    np.testing.assert_allclose(
+        read_nifti_masked(scaled, sphere, n_volumes=4),
+        read_nifti_masked(img, sphere, n_volumes=4) * 2 + 1, rtol=1e-6)
+
     # Test Write
     dat.write(os.path.join(str(tmpdir.join('test_write.nii'))))
     assert Brain_Data(os.path.join(str(tmpdir.join('test_write.nii'))))
@@ -101,10 +125,24 @@ def test_indexing(sim_brain_data):
     assert Brain_Data(d)
 
 
+def test_to_nifti(sim_brain_data):
+    masker = NiftiMasker(mask_img=sim_brain_data.mask).fit()
+    img = sim_brain_data.to_nifti()
+    assert np.all(np.asanyarray(img.dataobj) == np.asanyarray(masker.inverse_transform(sim_brain_data.data).dataobj))
+    assert np.all(sim_brain_data._mask_data(img) == masker.transform(img))
+    assert sim_brain_data.to_nifti(dtype=np.float32).get_data_dtype() == np.float32
+    sphere = create_sphere([0, 0, 0], radius=10)
+    masked = sim_brain_data.apply_mask(sphere)
+    assert np.all(Brain_Data(masked.to_nifti(), mask=sphere).data == masked.data)
+
+
 def test_concatenate(sim_brain_data):
     out = Brain_Data([x for x in sim_brain_data])
     assert isinstance(out, Brain_Data)
     assert len(out) == len(sim_brain_data)
+    assert np.all(out.data == sim_brain_data.data)
+    with pytest.raises(ValueError):
+        Brain_Data([sim_brain_data, sim_brain_data.apply_mask(create_sphere([0, 0, 0], radius=3))])
 
 
 def test_append(sim_brain_data):
@@ -114,6 +152,10 @@ def test_append(sim_brain_data):
 def test_ttest(sim_brain_data):
     out = sim_brain_data.ttest()
     assert out['t'].shape()[0] == shape_2d[1]
+    out = sim_brain_data.ttest(threshold_dict={'fdr': .05})
+    assert out['p_fdr'].shape()[0] == shape_2d[1]
+    assert np.all(out['p_fdr'].data >= out['p'].data)
+    assert isinstance(out['thr_t'], Brain_Data)
     distance = sim_brain_data.distance(method='correlation')
     assert isinstance(distance, Adjacency)
     assert distance.square_shape()[0] == shape_2d[0]
@@ -130,6 +172,7 @@ def test_regress(sim_brain_data):
     assert type(out['residual'].data) == np.ndarray
     assert out['beta'].shape() == (2, shape_2d[1])
     assert out['t'][1].shape()[0] == shape_2d[1]
+    assert out['p_fdr'].shape() == (2, shape_2d[1])
 
     # Robust OLS
     out = sim_brain_data.regress(mode='robust')
@@ -158,6 +201,50 @@ def test_extract_roi(sim_brain_data):
     assert len(sim_brain_data.extract_roi(mask)) == shape_2d[0]
 
 
+def test_seed_correlation(sim_brain_data):
+    rng = np.random.RandomState(0)
+    seeds = rng.randn(shape_2d[0], 3)
+    out = sim_brain_data.seed_correlation(seeds)
+    assert out.shape() == (3, shape_2d[1])
+    expected = [np.corrcoef(seeds[:, 1], sim_brain_data.data[:, v])[0, 1]
+                for v in [0, 10, 1000]]
+    assert np.allclose(out.data[1, [0, 10, 1000]], expected, atol=1e-6)
+    z = sim_brain_data.seed_correlation(pd.DataFrame(seeds), fisher_z=True,
+                                        chunk_size=1000)
+    assert np.allclose(np.tanh(z.data), out.data)
+    assert sim_brain_data.seed_correlation(seeds[:, 0]).shape() == (shape_2d[1],)
+
+    atlas = sim_brain_data[0].copy()
+    atlas.data = (np.arange(len(atlas.data)) % 3).astype(float)
+    roi = sim_brain_data.seed_correlation(atlas)
+    assert np.allclose(roi.data, sim_brain_data.seed_correlation(
+        sim_brain_data.extract_roi(atlas).T).data)
+    with pytest.raises(ValueError):
+        sim_brain_data.seed_correlation(seeds[1:])
+
+    # In-place changes to the data are picked up by later calls
+    data = sim_brain_data.copy()
+    data.seed_correlation(seeds)
+    data.data[:] = rng.randn(*data.shape())
+    expected = [np.corrcoef(seeds[:, 1], data.data[:, v])[0, 1]
+                for v in [0, 10, 1000]]
+    assert np.allclose(data.seed_correlation(seeds).data[1, [0, 10, 1000]],
+                       expected, atol=1e-6)
+    # Constant voxels are uncorrelated
+    data.data[:, :2] = [0, 1234.5]
+    assert np.all(data.seed_correlation(seeds).data[:, :2] == 0)
+
+
+def test_sliding_window_correlation(sim_brain_data):
+    atlas = sim_brain_data[0].copy()
+    atlas.data = (np.arange(len(atlas.data)) % 5).astype(float)
+    roi = sim_brain_data.extract_roi(atlas)
+    out = sim_brain_data.sliding_window_correlation(atlas, 4)
+    assert isinstance(out, Adjacency)
+    assert out.data.shape == (shape_2d[0] - 3, 6)
+    assert np.allclose(out[0].squareform() + np.eye(4), np.corrcoef(roi[:, :4]))
+
+
 def test_r_to_z(sim_brain_data):
     z = sim_brain_data.r_to_z()
     assert z.shape() == sim_brain_data.shape()
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 import pandas as pd
 from nltools.stats import (one_sample_permutation,
                            two_sample_permutation,
@@ -8,14 +9,30 @@ from nltools.stats import (one_sample_permutation,
                            downsample,
                            upsample,
                            winsorize,
+                           trim,
                            align,
+                           isc,
+                           isfc,
+                           seed_correlation,
+                           sliding_window_correlation,
                            transform_pairwise,
+                           procrustes_distance,
+                           distance_correlation,
+                           distance_correlation_batch,
+                           u_center,
+                           adjust_pvalues,
+                           fdr,
+                           holm_bonf,
                            _calc_pvalue,
-                           find_spikes)
+                           find_spikes,
+                           _frame_stats_array)
 from nltools.simulator import Simulator
+from nltools.data import Design_Matrix
 from nltools.mask import create_sphere
 from sklearn.metrics import pairwise_distances
-from scipy.spatial.distance import squareform
+from scipy.spatial.distance import squareform, pdist
+from scipy.spatial import procrustes
+from scipy.stats import ttest_ind, pearsonr, spearmanr, kendalltau
 
 # import pytest
 
@@ -26,14 +43,39 @@ def test_permutation():
     y = dat[:, 1]
     stats = two_sample_permutation(x, y, tail=1, n_permute=1000)
     assert (stats['mean'] < -2) & (stats['mean'] > -6) & (stats['p'] < .001)
+    stats = two_sample_permutation(x, y, n_permute=1000, welch=True)
+    np.testing.assert_almost_equal(stats['t'],
+                                   ttest_ind(x, y, equal_var=False)[0])
+    assert stats['p'] < .001
+    stats = two_sample_permutation(np.vstack([x, y]).T, np.vstack([y, y]).T,
+                                   n_permute=1000)
+    assert stats['mean'].shape == (2,)
+    assert (stats['p'][0] < .001) & (stats['p'][1] == 1)
     stats = one_sample_permutation(x-y, tail=1, n_permute=1000)
     assert (stats['mean'] < -2) & (stats['mean'] > -6) & (stats['p'] < .001)
+    stats = one_sample_permutation(np.vstack([x-y, x-y+4]).T, n_permute=1000,
+                                   random_state=0)
+    assert stats['mean'].shape == (2,)
+    assert (stats['p'][0] < .001) & (stats['p'][1] > .001)
+    assert np.array_equal(stats['p'], one_sample_permutation(
+        np.vstack([x-y, x-y+4]).T, n_permute=1000, random_state=0,
+        n_jobs=1)['p'])
     stats = correlation_permutation(x, y, metric='pearson', tail=1)
     assert (stats['correlation'] > .4) & (stats['correlation'] < .85) & (stats['p'] < .001)
     stats = correlation_permutation(x, y, metric='spearman', tail=1)
     assert (stats['correlation'] > .4) & (stats['correlation'] < .85) & (stats['p'] < .001)
     stats = correlation_permutation(x, y, metric='kendall', tail=2)
     assert (stats['correlation'] > .4) & (stats['correlation'] < .85) & (stats['p'] < .001)
+    for metric, func in zip(['pearson', 'spearman', 'kendall'],
+                            [pearsonr, spearmanr, kendalltau]):
+        stats = correlation_permutation(x[:50], np.round(y[:50]),
+                                        metric=metric, n_permute=1000,
+                                        random_state=0)
+        np.testing.assert_almost_equal(stats['correlation'],
+                                       func(x[:50], np.round(y[:50]))[0])
+        assert stats['p'] == correlation_permutation(
+            x[:50], np.round(y[:50]), metric=metric, n_permute=1000,
+            random_state=0, n_jobs=1)['p']
     # with pytest.raises(ValueError):
     # 	correlation_permutation(x, y, metric='kendall',tail=3)
     # with pytest.raises(ValueError):
@@ -51,6 +93,12 @@ def test_permutation():
     y = squareform(dat[:, 1])
     stats = matrix_permutation(x, y, n_permute=1000)
     assert (stats['correlation'] > .4) & (stats['correlation'] < .85) & (stats['p'] < .001)
+    stats = matrix_permutation([x, y, squareform(np.random.randn(190))], y,
+                               n_permute=1000, metric='kendall')
+    assert stats['correlation'].shape == (3,)
+    np.testing.assert_almost_equal(stats['correlation'][0],
+                                   kendalltau(dat[:, 0], dat[:, 1])[0])
+    assert (stats['correlation'][1] == 1) & (stats['p'][1] < .001)
 
     # Test jackknife_permutation
     dat = np.random.multivariate_normal([5, 10, 15, 25, 35, 45],
@@ -67,14 +115,48 @@ def test_permutation():
     stats = jackknife_permutation(data1, data2)
     print(stats)
     assert (stats['correlation'] >= .4) & (stats['correlation'] <= .99) & (stats['p'] <= .05)
-
-
-def test_downsample():
+    for metric, func in zip(['pearson', 'kendall'], [pearsonr, kendalltau]):
+        stats = jackknife_permutation(data1, data2, metric=metric,
+                                      p_value='ttest')
+        np.testing.assert_almost_equal(
+            stats['all_r'], [func(np.delete(data1[i], i),
+                                  np.delete(data2[i], i))[0]
+                             for i in range(data1.shape[0])])
+
+
+def test_adjust_pvalues():
+    p = np.array([.01, .04, .03, np.nan, .005, 0])
+    adjusted, thr = adjust_pvalues(p, method='fdr')
+    np.testing.assert_almost_equal(adjusted, [.05 / 3, .04, .0375, np.nan,
+                                              .0125, 0])
+    assert thr == .04
+    adjusted, thr = adjust_pvalues(p, method='holm')
+    np.testing.assert_almost_equal(adjusted, [.03, .06, .06, np.nan, .02, 0])
+    assert thr == .01
+    p = np.random.rand(3, 100) ** 4
+    adjusted, thr = adjust_pvalues(p, method='fdr')
+    assert adjusted.shape == p.shape
+    np.testing.assert_array_equal(fdr(p), thr)
+    np.testing.assert_array_equal(fdr(p[1]), thr[1])
+    np.testing.assert_array_equal(holm_bonf(p)[2], holm_bonf(p[2]))
+    assert fdr(np.array([.5, .9])) == -1
+
+
+def test_downsample(sim_brain_data):
     dat = pd.DataFrame()
     dat['x'] = range(0, 100)
     dat['y'] = np.repeat(range(1, 11), 10)
     assert((dat.groupby('y').mean().values.ravel() == downsample(data=dat['x'], sampling_freq=10, target=1, target_type='hz', method='mean').values).all)
     assert((dat.groupby('y').median().values.ravel() == downsample(data=dat['x'], sampling_freq=10, target=1, target_type='hz', method='median').values).all)
+    ds = downsample(data=dat.values, sampling_freq=10, target=1,
+                    target_type='hz')
+    assert isinstance(ds, np.ndarray)
+    np.testing.assert_array_equal(ds, dat.groupby('y').mean().reset_index().values[:, [1, 0]])
+    ds = downsample(data=np.arange(10), target=4, method='median')
+    np.testing.assert_array_equal(ds, [1.5, 5.5, 8.5])
+    ds = downsample(data=sim_brain_data, target=2)
+    assert ds.shape() == (3, sim_brain_data.shape()[1])
+    np.testing.assert_almost_equal(ds[0].data, sim_brain_data[:2].mean().data)
     # with pytest.raises(ValueError):
     # 	downsample(data=list(dat['x']),sampling_freq=10,target=1,target_type='hz',method='median')
     # with pytest.raises(ValueError):
@@ -93,6 +175,9 @@ def test_upsample():
     fs = 3
     us = upsample(dat, sampling_freq=1, target=fs, target_type='hz')
     assert(dat.shape[0]*fs-fs == us.shape[0])
+    us = upsample(dat.values, sampling_freq=1, target=fs, target_type='hz')
+    np.testing.assert_almost_equal(us[:4, 0], [0, 1 / 3, 2 / 3, 1])
+    assert us.shape == (dat.shape[0]*fs-fs, 2)
     # with pytest.raises(ValueError):
     # 	upsample(dat,sampling_freq=1,target=fs,target_type='hz',method='doesnotwork')
     # with pytest.raises(ValueError):
@@ -123,6 +208,28 @@ def test_winsorize():
                                89., 28., -5., 41.])
     assert(np.round(np.mean(out)) == np.round(np.mean(correct_result)))
 
+    # numpy arrays, in place, and multiple columns at once
+    data = np.hstack([outlier_test.values, outlier_test.values * 2]).astype(float)
+    out = winsorize(data, cutoff={'quantile': [0.05, .95]},
+                    replace_with_cutoff=False)
+    np.testing.assert_array_equal(out[:, 0], winsorize(
+        outlier_test, cutoff={'quantile': [0.05, .95]},
+        replace_with_cutoff=False).values.squeeze())
+    np.testing.assert_array_equal(out[:, 1], out[:, 0] * 2)
+    assert data[4, 0] == 1053
+    winsorize(data, cutoff={'quantile': [0.05, .95]},
+              replace_with_cutoff=False, inplace=True)
+    np.testing.assert_array_equal(data, out)
+    out = trim(outlier_test, cutoff={'std': [2, 2]}).values.squeeze()
+    assert np.isnan(out[4]) & (np.sum(np.isnan(out)) == 1)
+
+
+def test_winsorize_brain_data(sim_brain_data):
+    out = winsorize(sim_brain_data, cutoff={'std': [1, 1]})
+    assert out.shape() == sim_brain_data.shape()
+    assert np.all(out.data.max(axis=0) <= sim_brain_data.data.max(axis=0))
+    assert np.any(out.data != sim_brain_data.data)
+
 
 def test_align():
     # Test hyperalignment matrix
@@ -262,6 +369,187 @@ def test_align():
     assert len(out['isc']) == out['transformed'][0].shape()[0]
 
 
+def test_isc(sim_brain_data):
+    rng = np.random.RandomState(0)
+    shared = rng.randn(50, 10)
+    data = shared * np.linspace(0, 2, 10) + rng.randn(8, 50, 10)
+
+    pairs = [(i, j) for i in range(8) for j in range(i + 1, 8)]
+    pairwise = [np.mean([pearsonr(data[i, :, v], data[j, :, v])[0]
+                         for i, j in pairs]) for v in range(10)]
+    stats = isc(data)
+    assert np.allclose(stats['isc'], pairwise)
+
+    # Unequal variances distinguish the raw average from a z-scored one
+    scaled = data * np.array([1, 5, 1, 1, 10, 1, 2, 1])[:, None, None]
+    stats = isc(list(scaled), method='leave_one_out')
+    loo = [[pearsonr(scaled[s, :, v],
+                     np.delete(scaled, s, axis=0).mean(axis=0)[:, v])[0]
+            for v in range(10)] for s in range(8)]
+    assert np.allclose(stats['subjects'], loo)
+    assert np.allclose(stats['isc'], stats['subjects'].mean(axis=0))
+
+    for method in ['pairwise', 'leave_one_out']:
+        for inference in ['bootstrap', 'permutation']:
+            stats = isc(data, method=method, inference=inference,
+                        n_permute=500, random_state=0)
+            assert stats['p'][-1] < .05
+            assert stats['p'][0] > .05
+    with pytest.raises(ValueError):
+        isc(data, method='average')
+
+    subjects = [sim_brain_data + rng.randn(*sim_brain_data.shape()) for _ in range(3)]
+    stats = isc(subjects, inference='permutation', n_permute=100)
+    assert isinstance(stats['isc'], type(sim_brain_data))
+    assert stats['p'].shape() == stats['isc'].shape() == sim_brain_data.shape()[1:]
+
+
+def test_isfc(sim_brain_data):
+    rng = np.random.RandomState(0)
+    data = rng.randn(5, 40, 6) + rng.randn(40, 6)
+    data *= np.array([1, 5, 1, 10, 2])[:, None, None]
+    out = isfc(data)
+    assert out.matrix_type == 'similarity'
+    assert out.data.shape == (5, 15)
+    for s in range(5):
+        others = np.delete(data, s, axis=0).mean(axis=0)
+        r = np.array([[pearsonr(data[s][:, i], others[:, j])[0]
+                       for j in range(6)] for i in range(6)])
+        r = (r + r.T) / 2
+        assert np.allclose(out[s].squareform(), r - np.diag(np.diag(r)))
+
+    atlas = sim_brain_data[0].copy()
+    atlas.data = rng.randint(0, 5, size=atlas.data.shape).astype(float)
+    subjects = [sim_brain_data + rng.randn(*sim_brain_data.shape()) for _ in range(3)]
+    out = isfc(subjects, mask=atlas)
+    assert out.data.shape == (3, 6)
+    expected = isfc(np.stack([x.extract_roi(atlas).T for x in subjects]))
+    assert np.allclose(out.data, expected.data, atol=1e-5)
+
+
+def test_seed_correlation(sim_brain_data):
+    rng = np.random.RandomState(0)
+    subjects = []
+    for _ in range(2):
+        x = sim_brain_data.copy()
+        x.data = rng.randn(*x.shape()).astype(np.float32)
+        subjects.append(x)
+    atlas = sim_brain_data[0].copy()
+    atlas.data = (np.arange(len(atlas.data)) % 3).astype(float)
+    out = seed_correlation(subjects, atlas)
+    out_z = seed_correlation(subjects, atlas, fisher_z=True)
+    assert len(out) == 2
+    for x, maps, maps_z in zip(subjects, out, out_z):
+        # float64 reference; voxel means and norms are accumulated in the
+        # float32 precision of the data, one rounding per image
+        data = x.data.astype(float)
+        seeds = np.column_stack([data[:, atlas.data == k].mean(axis=1)
+                                 for k in [1, 2]])
+        seeds = seeds - seeds.mean(axis=0)
+        data = data - data.mean(axis=0)
+        expected = (np.dot(seeds.T, data) / np.linalg.norm(seeds, axis=0)[:, None]
+                    / np.linalg.norm(data, axis=0))
+        tol = len(data) * np.finfo(np.float32).eps
+        assert np.allclose(maps.data, expected, rtol=0, atol=tol)
+        assert np.allclose(maps_z.data, np.arctanh(maps.data))
+    with pytest.raises(ValueError):
+        seed_correlation(subjects, [rng.randn(len(sim_brain_data))])
+
+
+def test_sliding_window_correlation():
+    rng = np.random.RandomState(0)
+    data = rng.randn(100, 5) + np.cumsum(rng.randn(100, 1), axis=0)
+    triu = np.triu_indices(5, k=1)
+
+    def weighted(x, w):
+        x = x - np.dot(w, x) / w.sum()
+        cov = np.dot(x.T * w, x)
+        return (cov / np.sqrt(np.outer(np.diag(cov), np.diag(cov))))[triu]
+
+    k = np.arange(20)
+    for step in [1, 3, 25]:
+        out = sliding_window_correlation(data, 20, step=step)
+        assert out.matrix_type == 'similarity'
+        assert len(out) == (100 - 20) // step + 1
+        for w in [0, 1, len(out) - 1]:
+            x = data[w * step:w * step + 20]
+            assert np.allclose(out[w].data, np.corrcoef(x.T)[triu])
+
+        hann = sliding_window_correlation(data, 20, step=step, taper='hann')
+        exponential = sliding_window_correlation(data, 20, step=step,
+                                                 taper='exponential', tau=5)
+        x = data[-20 - (80 % step):][:20]
+        assert np.allclose(hann[-1].data,
+                           weighted(x, .5 - .5 * np.cos(2 * np.pi * k / 19)))
+        assert np.allclose(exponential[-1].data, weighted(x, np.exp(k / 5)))
+    with pytest.raises(ValueError):
+        sliding_window_correlation(data, 200)
+    with pytest.raises(ValueError):
+        sliding_window_correlation(data, 20, taper='gaussian')
+    with pytest.raises(ValueError):
+        sliding_window_correlation(data, 20, taper='exponential', tau=0)
+
+    # Short exponential tapers keep the weights finite
+    data = rng.randn(1600, 3)
+    triu = np.triu_indices(3, k=1)
+    k = np.arange(1500)
+    out = sliding_window_correlation(data, 1500, taper='exponential', tau=2)
+    assert np.all(np.isfinite(out.data))
+    for w in [0, 50, len(out) - 1]:
+        assert np.allclose(out[w].data, weighted(data[w:w + 1500],
+                                                 np.exp((k - 1499) / 2)))
+
+
+def test_procrustes_distance():
+    mat1 = np.random.randn(50, 5)
+    mat2 = np.dot(mat1, np.linalg.qr(np.random.randn(5, 5))[0])
+    mat2 = mat2 + np.random.randn(50, 5) * .5
+    stats = procrustes_distance(mat1, mat2, n_permute=1000)
+    np.testing.assert_almost_equal(stats['similarity'],
+                                   1 - procrustes(mat1, mat2)[2])
+    assert stats['p'] < .001
+    stats_eig = procrustes_distance(mat1, mat2, n_permute=1000, method='eig')
+    np.testing.assert_almost_equal(stats['similarity'],
+                                   stats_eig['similarity'])
+    stats = procrustes_distance(mat1, np.random.randn(50, 3), n_permute=1000)
+    assert (stats['similarity'] > 0) & (stats['similarity'] < 1)
+
+
+def test_distance_correlation():
+    rng = np.random.RandomState(0)
+    x = rng.randn(40, 3)
+    y = x[:, 0] ** 2 + rng.randn(40)
+
+    def full(a, b):
+        a = u_center(squareform(pdist(a.reshape(len(a), -1))))
+        b = u_center(squareform(pdist(b.reshape(len(b), -1))))
+        return (a * b).sum() / np.sqrt((a * a).sum() * (b * b).sum())
+
+    # Blocked 2d and O(n log n) 1d paths match the full distance matrices
+    for a, b in [(x, y), (x[:, 0], y), (np.round(x[:, 0]), np.round(y))]:
+        stats = distance_correlation(a, b, return_all_stats=True)
+        assert np.isclose(stats['d_correlation_adjusted'], full(a, b))
+    stats = distance_correlation(x[:, 0], y)
+    assert np.isclose(stats['d_correlation_adjusted'] ** 2, full(x[:, 0], y))
+    assert stats['df'] == 40 * 37 / 2 - 1
+    assert stats['p'] < .05
+    assert distance_correlation(x[:, 0], x[:, 0] ** 2,
+                                bias_corrected=False)['d_correlation_adjusted'] > .4
+    with pytest.raises(ValueError):
+        distance_correlation(x, y[:-1])
+
+    # Batched over columns and over lists of arrays
+    ys = np.column_stack([y, rng.randn(40), x[:, 1]])
+    for batch in [distance_correlation_batch(x, ys),
+                  distance_correlation_batch(x, list(ys.T))]:
+        assert batch['d_correlation_adjusted'].shape == (3,)
+        for i in range(3):
+            single = distance_correlation(x, ys[:, i])
+            assert np.isclose(batch['d_correlation_adjusted'][i],
+                              single['d_correlation_adjusted'])
+            assert np.isclose(batch['p'][i], single['p'])
+
+
 def test_transform_pairwise():
     n_features = 50
     n_samples = 100
@@ -284,6 +572,20 @@ def test_transform_pairwise():
     assert y_new.ndim == 2
     a = y_new[:, 1] == np.repeat(np.arange(1, 1+n_subs), ((n_samples/n_subs)*(n_samples/n_subs-1))/2)
     assert a.all()
+    # Test lazy blocks of pairs
+    blocks = list(transform_pairwise(X, y, batch_size=100))
+    assert all([x.shape[0] <= 100 for x, _ in blocks])
+    assert np.allclose(np.vstack([x for x, _ in blocks]), x_new)
+    assert np.all(np.vstack([b for _, b in blocks]) == y_new)
+    # Integer data stays integer
+    X_int = np.random.randint(0, 10, size=(n_samples, n_features))
+    x_new, y_new = transform_pairwise(X_int, y[:, 0])
+    assert x_new.dtype == X_int.dtype
+    i, j = np.triu_indices(n_samples, k=1)
+    assert np.array_equal(x_new, (X_int[i] - X_int[j]) *
+                          np.sign(y[i, 0] - y[j, 0])[:, None] * y_new[:, None])
+    blocks = list(transform_pairwise(X_int, y[:, 0], batch_size=100))
+    assert np.array_equal(np.vstack([x for x, _ in blocks]), x_new)
 
 def test_find_spikes():
     sim = Simulator()
@@ -295,7 +597,18 @@ def test_find_spikes():
     spikes = find_spikes(d1)
     assert isinstance(spikes, pd.DataFrame)
     assert spikes.shape[0] == len(d1)
+    global_mn, frame_diff = _frame_stats_array(d1.data, chunk_size=7)
+    assert np.array_equal(global_mn, d1.data.mean(axis=1))
+    assert np.array_equal(frame_diff,
+                          np.mean(np.abs(np.diff(d1.data, axis=0)), axis=1))
 
     spikes = find_spikes(d1.to_nifti())
     assert isinstance(spikes, pd.DataFrame)
     assert spikes.shape[0] == len(d1)
+
+    d1.data[5, :] += 100
+    spikes = find_spikes(d1, sampling_freq=.5)
+    assert isinstance(spikes, Design_Matrix)
+    assert spikes['global_spike1'].values[5] == 1
+    assert spikes.drop('TR', axis=1).sum().sum() == spikes.shape[1] - 1
+    assert np.all(spikes.values == find_spikes(d1.to_nifti(), sampling_freq=.5).values)
@@ -24,10 +24,12 @@ import os
 from sklearn.pipeline import Pipeline
 from sklearn.utils import check_random_state
 from scipy.spatial.distance import squareform
+from scipy.sparse import csr_matrix, issparse, vstack as sparse_vstack
 import numpy as np
 import pandas as pd
 import collections
 from types import GeneratorType
+from copy import deepcopy
 
 
 def get_resource_path():
@@ -187,23 +189,98 @@ def all_same(items):
     return np.all(x == items[0] for x in items)
 
 
+def _same_mask(img1, img2):
+    '''Helper function to check if two nibabel masks cover the same voxels.'''
+    if img1 is img2:
+        return True
+    if img1.shape[:3] != img2.shape[:3]:
+        return False
+    if not np.allclose(img1.affine, img2.affine):
+        return False
+    return np.array_equal(np.asanyarray(img1.dataobj) != 0,
+                          np.asanyarray(img2.dataobj) != 0)
+
+
+def _concatenate_frames(frames):
+    '''Helper function to concatenate the non-empty X/Y attributes of a list
+        of Brain_Data or Adjacency objects in a single pass.'''
+    frames = [x for x in frames if x.size]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0].copy()
+    if hasattr(frames[0], 'polys'):
+        # Design_Matrix knows how to keep polynomial terms separate
+        return frames[0].append(frames[1:])
+    return pd.concat(frames)
+
+
 def concatenate(data):
-    '''Concatenate a list of Brain_Data() or Adjacency() objects'''
+    '''Concatenate a list of Brain_Data() or Adjacency() objects
+
+        Shapes (and masks for Brain_Data) are validated up front and the
+        data are stacked in a single pass rather than by repeated append.
+
+        Args:
+            data: (list) list of Brain_Data or Adjacency instances
+
+        Returns:
+            out: (Brain_Data, Adjacency) concatenated instance
+    '''
+
+    from nltools.data import Brain_Data, Adjacency
 
     if not isinstance(data, list):
         raise ValueError('Make sure you are passing a list of objects.')
 
-    if all([isinstance(x, data[0].__class__) for x in data]):
-        # Temporarily Removing this for circular imports (LC)
-        # if not isinstance(data[0], (Brain_Data, Adjacency)):
-        #     raise ValueError('Make sure you are passing a list of Brain_Data'
-        #                     ' or Adjacency objects.')
-
-        out = data[0].__class__()
-        for i in data:
-            out = out.append(i)
-    else:
+    if not all([isinstance(x, data[0].__class__) for x in data]):
         raise ValueError('Make sure all objects in the list are the same type.')
+    if not isinstance(data[0], (Brain_Data, Adjacency)):
+        raise ValueError('Make sure you are passing a list of Brain_Data'
+                         ' or Adjacency objects.')
+
+    cls = data[0].__class__
+    data = [x for x in data if not x.isempty()]
+    if not data:
+        return cls()
+    if len(data) == 1:
+        return data[0].copy()
+
+    ref = data[0]
+    if isinstance(ref, Brain_Data):
+        n_voxels = ref.shape()[-1]
+        ref_mask = ref.nifti_masker.mask_img
+        for x in data[1:]:
+            if x.shape()[-1] != n_voxels:
+                raise ValueError('Data to append has different number of '
+                                 'voxels then Brain_Data instance.')
+            if not _same_mask(ref_mask, x.nifti_masker.mask_img):
+                raise ValueError('Make sure all Brain_Data instances have '
+                                 'the same mask.')
+        X = _concatenate_frames([x.X for x in data])
+    else:
+        square_shape = ref.square_shape()
+        for x in data[1:]:
+            if x.square_shape() != square_shape:
+                raise ValueError('Data is not the same shape as Adjacency '
+                                 'instance.')
+
+    # Only copy metadata from the first object; data are stacked below
+    out = cls.__new__(cls)
+    for key, value in ref.__dict__.items():
+        if key not in ['data', 'X', 'Y']:
+            setattr(out, key, deepcopy(value))
+    if any(issparse(x.data) for x in data):
+        out.data = sparse_vstack([x.data if issparse(x.data) else
+                                  csr_matrix(np.atleast_2d(x.data))
+                                  for x in data], format='csr')
+    else:
+        out.data = np.vstack([x.data for x in data])
+    out.Y = _concatenate_frames([x.Y for x in data])
+    if isinstance(ref, Brain_Data):
+        out.X = X
+    else:
+        out.is_single_matrix = False
     return out
 
 